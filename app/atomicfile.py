@@ -0,0 +1,32 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+# The mode open() gives a new file. The umask can only be read by setting it, which goes for the whole
+# process, so it's done once, at import, before there are threads about.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+@contextmanager
+def replace_atomically(path: str, mode: str = 'wb') -> Iterator[IO]:
+    """
+    Write path's new contents to a temporary file beside it, then replace path with that in one go, so that
+    whoever reads path (or has the old file mapped) sees either the old contents or the new ones. mkstemp
+    creates the temporary file 0600; it's given FILE_MODE, like any other new file, before it takes path's
+    place. If writing fails, path is left as it was.
+    """
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, mode) as out:
+            yield out
+        os.chmod(temporary, FILE_MODE)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,77 @@
+# Throughput of turning ccxt's unified trades back into FTX fills, the CPU-bound part of a --rebuild in
+# use-ccxt.py, on synthetic trades. Runs offline.
+#
+#   python app/bench-ccxt.py [trades] [--chunk-size 10000]
+import time
+import random
+import argparse
+from decimal import Decimal
+from itertools import cycle, islice
+from transforms import MarketPrecisions, tradesToFills
+
+# (symbol, amount tick, price tick, starting price)
+MARKETS = [('BTC/USD', 0.0001, 1.0, 40000), ('ETH/USD', 0.001, 0.1, 3000), ('SOL/USD', 0.01, 0.0025, 90),
+           ('SOL/USDC', 0.01, 0.0025, 90), ('ETH/BTC', 0.001, 0.000005, 0.07)]
+SIZES = [0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0]
+POOL = 100000
+
+# Prices walk a few ticks at a time and sizes are mostly round numbers, as in real fills. Trades are
+# generated into a pool that's cycled through, since a million of them at once would be gigabytes.
+def syntheticTrades(count):
+  random.seed(0)
+  prices = {symbol: start for (symbol, _, _, start) in MARKETS}
+  for i in range(count):
+    (symbol, amountTick, priceTick, _) = random.choice(MARKETS)
+    prices[symbol] = max(priceTick, prices[symbol] + random.randint(-3, 3) * priceTick)
+    price = round(prices[symbol], 6)
+    amount = random.choice(SIZES) if random.random() < 0.8 else round(random.uniform(0.01, 10), 3)
+    side = random.choice(['buy', 'sell'])
+    (base, quote) = symbol.split('/')
+    fee = round(price * amount * 0.0007, 8)
+    info = {'id': 62902857 + i, 'market': symbol, 'future': None, 'baseCurrency': base, 'quoteCurrency': quote,
+            'type': 'order', 'side': side, 'price': price, 'size': amount, 'orderId': 4120253149 + i,
+            'time': '2022-03-14T18:02:18.436415+00:00', 'tradeId': 27130489 + i, 'feeRate': 0.0007, 'fee': fee,
+            'feeCurrency': quote, 'liquidity': 'maker'}
+    yield {'info': info, 'timestamp': 1647280938436, 'datetime': '2022-03-14T18:02:18.436Z', 'symbol': symbol,
+           'id': str(info['id']), 'order': str(info['orderId']), 'type': None, 'takerOrMaker': 'maker', 'side': side,
+           'price': price, 'amount': amount, 'cost': price * amount,
+           'fee': {'cost': fee, 'currency': quote, 'rate': 0.0007}}
+
+# How trades were converted before tradesToFills took them in chunks: every symbol split and every number
+# rounded, one trade at a time.
+def tradesToFillsOneByOne(precisions):
+  def stage(trades):
+    for trade in trades:
+      (baseCurrency, quoteCurrency) = trade['symbol'].split('/')
+      yield dict(trade['info'], baseCurrency=baseCurrency, quoteCurrency=quoteCurrency,
+                 size=precisions.amount(trade['symbol'], trade['amount']),
+                 price=precisions.price(trade['symbol'], trade['price']),
+                 fee=Decimal(str(trade['fee']['cost'])), feeCurrency=trade['fee']['currency'])
+  return stage
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark converting ccxt trades into FTX fills.')
+  parser.add_argument('trades', nargs='?', type=int, default=1000000, help='how many trades to convert')
+  parser.add_argument('--chunk-size', type=int, default=10000, help='trades tradesToFills takes at a time')
+  args = parser.parse_args()
+
+  pool = list(syntheticTrades(min(args.trades, POOL)))
+  precisions = MarketPrecisions({symbol: {'precision': {'amount': amountTick, 'price': priceTick}}
+                                 for (symbol, amountTick, priceTick, _) in MARKETS})
+  stages = [('one by one', tradesToFillsOneByOne(precisions)),
+            ('chunked', tradesToFills(precisions, chunkSize=args.chunk_size))]
+
+  # Both have to agree on every fill before either is worth timing.
+  for (expected, actual) in zip(stages[0][1](pool), stages[1][1](pool)):
+    assert expected == actual, (expected, actual)
+
+  for (name, stage) in stages:
+    started = time.perf_counter()
+    for _ in stage(islice(cycle(pool), args.trades)):
+      pass
+    seconds = time.perf_counter() - started
+    print('{0:>12}: {1:8.3f}s {2:10.0f} trades/s {3:8.0f} ns/trade'.format(
+      name, seconds, args.trades / seconds, seconds / args.trades * 1e9))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,54 @@
+# Compares response decoders on recorded payloads: every response kept by --cache-dir, or a synthetic page
+# of fills when no cache is given.
+#
+#   python app/bench-decoding.py [cache-dir]
+import os
+import sys
+import gzip
+import json
+import glob
+import random
+import timeit
+from decoding import SimplejsonDecoder, JsonDecoder
+
+def syntheticFills(count):
+  random.seed(0)
+  # Shaped like the fills documented in use-ftx-webapi.py.
+  fills = [{'id': 63820377 + i, 'market': 'SOL/USD', 'future': None, 'baseCurrency': 'SOL', 'quoteCurrency': 'USD',
+            'type': 'order', 'side': random.choice(['buy', 'sell']), 'price': round(random.uniform(10, 200), 4),
+            'size': round(random.uniform(0.01, 50), 2), 'orderId': 4216671021 + i,
+            'time': '2022-03-21T13:54:26.393415+00:00', 'tradeId': 27130489 + i, 'feeRate': 0.0008,
+            'fee': round(random.uniform(0, 0.1), 8), 'feeCurrency': 'SOL', 'liquidity': random.choice(['maker', 'taker'])}
+           for i in range(count)]
+  return json.dumps({'success': True, 'result': fills}).encode()
+
+if len(sys.argv) > 1:
+  payloads = []
+  for path in glob.glob(os.path.join(sys.argv[1], '*', '*.gz')):
+    with open(path, 'rb') as cached:
+      payloads.append(gzip.decompress(cached.read()))
+else:
+  payloads = [syntheticFills(5000) for _ in range(4)]
+size = sum(len(payload) for payload in payloads)
+print('{0} payloads, {1:.1f} MB'.format(len(payloads), size / 1e6))
+
+def chunked(payload, chunkSize = 1 << 16):
+  return (payload[i:i + chunkSize] for i in range(0, len(payload), chunkSize))
+
+def streamAll(decoder):
+  for payload in payloads:
+    # Not every recorded response is a list of records.
+    if b'"result": [' in payload or b'"result":[' in payload:
+      for record in decoder.iter_results(chunked(payload)):
+        pass
+    else:
+      decoder.loads(payload)
+
+benchmarks = [
+  ('simplejson, whole document', lambda: [SimplejsonDecoder().loads(payload) for payload in payloads]),
+  ('json, whole document', lambda: [JsonDecoder().loads(payload) for payload in payloads]),
+  ('json, streamed result', lambda: streamAll(JsonDecoder())),
+]
+for (name, run) in benchmarks:
+  seconds = min(timeit.repeat(run, number=1, repeat=3))
+  print('{0:>28}: {1:8.1f} MB/s'.format(name, size / seconds / 1e6))
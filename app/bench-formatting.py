@@ -0,0 +1,30 @@
+# Micro-benchmark of what it costs to render one posting.
+#
+#   python app/bench-formatting.py [postings]
+import sys
+import random
+import timeit
+from decimal import Decimal
+from ledger import LedgerEntry, normalizeCurrency
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+random.seed(0)
+
+# Sizes and prices come from a small set of markets with fixed tick sizes, so values repeat a lot, as they
+# do in real fills.
+prices = [Decimal(random.randrange(1, 5000000)).scaleb(-2) for _ in range(2000)]
+sizes = [Decimal(random.randrange(1, 100000)).scaleb(-4) for _ in range(2000)]
+items = [LedgerEntry.Item(account='Assets:Wallet', currency=random.choice(['BTC', 'ETH', 'SOL']),
+                          quantity=random.choice(sizes), inputCommodity='USD', inputQuantity=random.choice(prices),
+                          description='Purchase')
+         for _ in range(count)]
+
+# How postings were rendered before QuantityFormatter: every quantity formatted from scratch, and the cost
+# currency normalized again on every render.
+def renderUncached(item):
+  costBasis = '{{{quantity:.13f} {commodity}}}'.format(quantity = item.inputQuantity, commodity = normalizeCurrency(item.inputCommodity))
+  return "{account}\t{quantity:.13f} {currency} {costBasis} {comment}".format(account = item.account, quantity = item.quantity, currency = item.currency, costBasis = costBasis, comment = item.generateDescriptionComment())
+
+for (name, render) in [('uncached', renderUncached), ('QuantityFormatter', repr)]:
+  seconds = min(timeit.repeat(lambda: [render(item) for item in items], number=1, repeat=5))
+  print('{0:>20}: {1:8.0f} ns/posting'.format(name, seconds / count * 1e9))
@@ -0,0 +1,155 @@
+# Times building a ledger, merging its entries back into order and writing it out, with the peak memory of
+# each stage, on synthetic fills, deposits and interest payments. Runs offline. Results go to a JSON file
+# that a later run can be compared against with --compare.
+#
+#   python app/bench-ledger.py [--sizes 10000 100000 1000000] [--output results.json] [--compare old.json]
+#
+# With --render-workers, the ledger is also written with its entries rendered by that many
+# processes, and the output has to hash the same as the serial one's.
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tracemalloc
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
+from ledger import Ledger
+from pipeline import Source, LedgerSink, runPipeline
+from transforms import fillTransactions, depositTransactions, lendingTransactions, borrowTransactions
+
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+MARKETS = [('BTC', 'USD'), ('ETH', 'USD'), ('SOL', 'USD'), ('SOL', 'USDC'), ('ETH', 'BTC')]
+
+# The shapes documented in use-ftx-webapi.py, with numbers as Decimals as the decoder hands them out.
+# Fills make up most of a history, so they're 70% of the records and the other kinds 10% each. Each source
+# runs in a thread of its own, so each has a generator of its own, or they'd differ from run to run.
+def syntheticFills(count):
+  rng = random.Random(0)
+  for i in range(count):
+    (base, quote) = rng.choice(MARKETS)
+    yield {'id': 63820377 + i, 'market': '{0}/{1}'.format(base, quote), 'future': None, 'baseCurrency': base,
+           'quoteCurrency': quote, 'type': 'order', 'side': rng.choice(['buy', 'sell']),
+           'price': Decimal(rng.randrange(1, 5000000)).scaleb(-2), 'size': Decimal(rng.randrange(1, 100000)).scaleb(-4),
+           'orderId': 4216671021 + i, 'time': (START + timedelta(seconds=37 * i)).isoformat(), 'tradeId': 27130489 + i,
+           'feeRate': Decimal('0.0008'), 'fee': Decimal(rng.randrange(1, 100000)).scaleb(-8),
+           'feeCurrency': rng.choice([base, quote]), 'liquidity': rng.choice(['maker', 'taker'])}
+
+def syntheticDeposits(count):
+  rng = random.Random(1)
+  for i in range(count):
+    yield {'id': 38252 + i, 'coin': rng.choice(['USD', 'BTC', 'SOL']), 'size': Decimal(rng.randrange(1, 10 ** 8)).scaleb(-4),
+           'status': 'complete', 'time': (START + timedelta(seconds=259 * i)).isoformat()}
+
+def syntheticInterest(count, field, seed):
+  rng = random.Random(seed)
+  for i in range(count):
+    yield {'coin': rng.choice(['USD', 'SOL']), 'time': (START + timedelta(hours=i // 2)).isoformat(),
+           'size': Decimal(rng.randrange(1, 10 ** 10)).scaleb(-6), 'rate': Decimal('0.00001142'),
+           field: Decimal(rng.randrange(1, 10 ** 12)).scaleb(-14), 'feeUsd': Decimal('1.5198590173526874')}
+
+def buildLedger(count, renderWorkers = None):
+  ledger = Ledger(renderWorkers=renderWorkers)
+  runPipeline([
+    Source('fills', lambda: syntheticFills(count * 7 // 10), fillTransactions()),
+    Source('deposits', lambda: syntheticDeposits(count // 10), depositTransactions),
+    Source('lending', lambda: syntheticInterest(count // 10, 'proceeds', 2), lendingTransactions),
+    Source('borrowing', lambda: syntheticInterest(count // 10, 'cost', 3), borrowTransactions),
+  ], LedgerSink(ledger))
+  return ledger
+
+def drainEntries(ledger):
+  for text in ledger.getEntries():
+    pass
+
+def writeLedger(ledger):
+  with open(os.devnull, 'w') as out:
+    ledger.write(out)
+
+class HashingWriter:
+  def __init__(self):
+    self.hash = hashlib.sha256()
+
+  def write(self, text):
+    self.hash.update(text.encode('utf-8'))
+
+def hashLedger(ledger):
+  out = HashingWriter()
+  ledger.write(out)
+  return out.hash.hexdigest()
+
+def measure(stage, *args, memory = False):
+  if memory:
+    tracemalloc.start()
+  started = time.perf_counter()
+  result = stage(*args)
+  seconds = time.perf_counter() - started
+  peak = None
+  if memory:
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  return (result, seconds, peak)
+
+def benchmark(count, memory, renderWorkers = None):
+  results = {}
+  if renderWorkers:
+    parallel = buildLedger(count, renderWorkers)
+    (parallelHash, writeSeconds, _) = measure(hashLedger, parallel)
+    serialHash = hashLedger(buildLedger(count))
+    if parallelHash != serialHash:
+      raise AssertionError('rendering with {0} workers changed the output'.format(renderWorkers))
+    results['write ({0} workers)'.format(renderWorkers)] = {'seconds': writeSeconds}
+  # Timings come from runs without tracemalloc, which slows allocation down a lot.
+  for traced in ([False, True] if memory else [False]):
+    (ledger, seconds, peak) = measure(buildLedger, count, memory=traced)
+    stages = [('build', seconds, peak)]
+    for (name, stage) in [('entries', drainEntries), ('write', writeLedger)]:
+      (_, seconds, peak) = measure(stage, ledger, memory=traced)
+      stages.append((name, seconds, peak))
+    for (name, seconds, peak) in stages:
+      result = results.setdefault(name, {})
+      if traced:
+        result['peakBytes'] = peak
+      else:
+        result['seconds'] = seconds
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark building and writing ledgers from synthetic histories.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='records per run')
+  parser.add_argument('--output', help='write the results here as JSON')
+  parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+  parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the tracemalloc runs')
+  parser.add_argument('--render-workers', type=int, help='also write with entries rendered by this many processes')
+  args = parser.parse_args()
+
+  report = {'python': platform.python_version(), 'platform': platform.platform(),
+            'time': datetime.now(timezone.utc).isoformat(), 'results': {}}
+  previous = {}
+  if args.compare:
+    with open(args.compare) as compareFile:
+      previous = json.load(compareFile)['results']
+
+  for count in args.sizes:
+    results = report['results'][str(count)] = benchmark(count, args.memory, args.render_workers)
+    for (name, result) in results.items():
+      line = '{0:>9} records {1:>20}: {2:8.3f} s {3:>10.0f} records/s'.format(count, name, result['seconds'], count / result['seconds'])
+      if 'peakBytes' in result:
+        line += ' {0:8.1f} MB peak'.format(result['peakBytes'] / 1e6)
+      before = previous.get(str(count), {}).get(name)
+      if before:
+        line += '  {0:+6.1%} time'.format(result['seconds'] / before['seconds'] - 1)
+        if 'peakBytes' in result and before.get('peakBytes'):
+          line += ' {0:+6.1%} memory'.format(result['peakBytes'] / before['peakBytes'] - 1)
+      print(line)
+      sys.stdout.flush()
+
+  if args.output:
+    with open(args.output, 'w') as out:
+      json.dump(report, out, indent=2)
+
+if __name__ == '__main__':
+  main()
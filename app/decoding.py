@@ -0,0 +1,122 @@
+import json
+import codecs
+from decimal import Decimal
+from typing import Any, Iterable, Iterator
+
+import simplejson
+
+
+class SimplejsonDecoder:
+    # What FtxClient always used to do: decode the body to text, then parse every float as a Decimal.
+    def loads(self, content: bytes) -> Any:
+        return simplejson.loads(content.decode('utf-8'), use_decimal=True)
+
+    def iter_results(self, chunks: Iterable[bytes]) -> Iterator[Any]:
+        data = self.loads(b''.join(chunks))
+        if not data['success']:
+            raise Exception(data['error'])
+        return iter(data['result'])
+
+
+class JsonDecoder:
+    """
+    Parses responses straight from bytes with the standard library's C scanner. Floats become Decimals so
+    that prices and sizes stay exact (pass exact=False for plain floats).
+
+    iter_results parses a {"success": ..., "result": [...]} response as its chunks arrive and yields the
+    records of `result` one at a time, so a large page never has to be held as a whole document.
+    """
+
+    def __init__(self, exact: bool = True) -> None:
+        self._decoder = json.JSONDecoder(parse_float=Decimal if exact else float)
+
+    def loads(self, content: bytes) -> Any:
+        return self._decoder.decode(content.decode('utf-8'))
+
+    def iter_results(self, chunks: Iterable[bytes]) -> Iterator[Any]:
+        return _ResultStream(self._decoder, chunks).records()
+
+
+class _ResultStream:
+    _WHITESPACE = ' \t\n\r'
+
+    def __init__(self, decoder: json.JSONDecoder, chunks: Iterable[bytes]) -> None:
+        self._decoder = decoder
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._position = 0
+        self._exhausted = False
+
+    def _read(self) -> bool:
+        if self._exhausted:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._exhausted = True
+            self._buffer = self._buffer[self._position:] + self._text.decode(b'', final=True)
+        else:
+            self._buffer = self._buffer[self._position:] + self._text.decode(chunk)
+        self._position = 0
+        return True
+
+    def _peek(self) -> str:
+        # Records are usually packed together, so check the next character before looping over whitespace.
+        if self._position < len(self._buffer) and self._buffer[self._position] not in self._WHITESPACE:
+            return self._buffer[self._position]
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in self._WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._read():
+                raise ValueError('response ended early')
+
+    def _expect(self, characters: str) -> str:
+        character = self._peek()
+        if character not in characters:
+            raise ValueError(f'expected one of {characters!r} but found {character!r}')
+        self._position += 1
+        return character
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # A number that runs to the end of the buffer may carry on in the next chunk.
+            if end == len(self._buffer) and self._read():
+                continue
+            self._position = end
+            return value
+
+    def records(self) -> Iterator[Any]:
+        fields = {}
+        self._expect('{')
+        if self._peek() == '}':
+            self._position += 1
+        else:
+            while True:
+                key = self._value()
+                self._expect(':')
+                if key == 'result' and self._peek() == '[':
+                    if fields.get('success') is False:
+                        raise Exception(fields.get('error'))
+                    self._position += 1
+                    if self._peek() == ']':
+                        self._position += 1
+                    else:
+                        while True:
+                            yield self._value()
+                            if self._expect(',]') == ']':
+                                break
+                else:
+                    fields[key] = self._value()
+                if self._expect(',}') == '}':
+                    break
+        if not fields.get('success'):
+            raise Exception(fields.get('error'))
@@ -0,0 +1,187 @@
+import os
+import mmap
+import json
+import struct
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from atomicfile import replace_atomically
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_SIDES = ['buy', 'sell']
+_LIQUIDITIES = ['maker', 'taker']
+
+
+def _time(record: bytes) -> int:
+    return struct.unpack_from('<q', record)[0]
+
+
+class _Times:
+    # The time column of the archive as a sequence, for bisect, without reading anything it doesn't look at.
+    def __init__(self, archive: 'FillArchive') -> None:
+        self._archive = archive
+
+    def __len__(self) -> int:
+        return len(self._archive)
+
+    def __getitem__(self, i: int) -> int:
+        return self._archive._RECORD.unpack_from(self._archive._map, self._archive._HEADER.size + i * self._archive._RECORD.size)[0]
+
+
+class FillArchive:
+    """
+    Fills, normalized into fixed-width records in time order, in one file that is memory-mapped for reading.
+
+    A record holds the time in nanoseconds since the epoch; the fill, order and trade ids; price, size, fee
+    and fee rate each as an integer and a power of ten, so they come back as exactly the Decimals that went
+    in; the market and currencies as ids into a table of names kept beside the archive (<path>.symbols);
+    and side and liquidity as small enums.
+
+    Records are found by time with a binary search over the mapped file, so slicing out a period only reads
+    that period, however many years the archive holds. Fills for one market are picked out of the period as
+    it's read.
+    """
+
+    _MAGIC = b'FILLS\x00\x00\x01'
+    _HEADER = struct.Struct('<8sQ')
+    #            time  id  orderId  tradeId  price  size  fee  feeRate  (exponents)  market base quote feeCcy side liquidity
+    _RECORD = struct.Struct('<qqqq' 'qqqq' 'bbbb' 'HHHH' 'BB')
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._symbols_path = path + '.symbols'
+        try:
+            with open(self._symbols_path) as symbols:
+                self._names: List[Optional[str]] = json.load(symbols)
+        except FileNotFoundError:
+            self._names = [None]
+        self._ids: Dict[Optional[str], int] = {name: i for i, name in enumerate(self._names)}
+        if not os.path.exists(path):
+            with open(path, 'wb') as archive:
+                archive.write(self._HEADER.pack(self._MAGIC, self._RECORD.size))
+        self._map = None
+        self._open()
+
+    def _open(self) -> None:
+        # The old map isn't closed, only dropped: rows still being read from it keep it open until they're done.
+        with open(self._path, 'rb') as archive:
+            magic, size = self._HEADER.unpack(archive.read(self._HEADER.size))
+            if magic != self._MAGIC or size != self._RECORD.size:
+                raise ValueError(f'{self._path} is not a fill archive this version can read')
+            archive.seek(0)
+            self._map = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __len__(self) -> int:
+        return (len(self._map) - self._HEADER.size) // self._RECORD.size
+
+    def _id(self, name: Optional[str]) -> int:
+        i = self._ids.get(name)
+        if i is None:
+            i = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return i
+
+    @staticmethod
+    def _scaled(value: Any) -> Tuple[int, int]:
+        value = value if isinstance(value, Decimal) else Decimal(str(value))
+        exponent = value.as_tuple().exponent
+        return int(value.scaleb(-exponent)), exponent
+
+    def _pack(self, fill: dict) -> bytes:
+        time = datetime.fromisoformat(fill['time']) - _EPOCH
+        nanoseconds = (time.days * 86400 + time.seconds) * 10 ** 9 + time.microseconds * 1000
+        price, price_exponent = self._scaled(fill['price'])
+        size, size_exponent = self._scaled(fill['size'])
+        fee, fee_exponent = self._scaled(fill['fee'])
+        fee_rate, fee_rate_exponent = self._scaled(fill['feeRate'])
+        return self._RECORD.pack(
+            nanoseconds, fill['id'], fill.get('orderId') or -1, fill.get('tradeId') or -1,
+            price, size, fee, fee_rate, price_exponent, size_exponent, fee_exponent, fee_rate_exponent,
+            self._id(fill.get('market')), self._id(fill['baseCurrency']), self._id(fill['quoteCurrency']),
+            self._id(fill['feeCurrency']), _SIDES.index(fill['side']), _LIQUIDITIES.index(fill['liquidity']))
+
+    def _save_symbols(self) -> None:
+        with replace_atomically(self._symbols_path, 'w') as symbols:
+            json.dump(self._names, symbols)
+
+    def append(self, fills: Iterable[dict]) -> int:
+        """
+        Add fills, skipping any whose id is already archived. Fills newer than everything archived are
+        appended to the file; anything older means merging and rewriting it. Returns how many were added.
+        """
+        records = sorted((self._pack(fill) for fill in fills), key=_time)
+        if not records:
+            return 0
+        first_time = self._RECORD.unpack(records[0])[0]
+        start = bisect_left(_Times(self), first_time)
+        # Only fills from the overlapping period can already be here.
+        archived = {row[1] for row in self._rows(start, len(self))}
+        new = []
+        for record in records:
+            fill_id = self._RECORD.unpack(record)[1]
+            if fill_id not in archived:
+                archived.add(fill_id)
+                new.append(record)
+        if not new:
+            return 0
+        self._save_symbols()
+        if start == len(self):
+            with open(self._path, 'ab') as archive:
+                archive.write(b''.join(new))
+        else:
+            offset = self._HEADER.size + start * self._RECORD.size
+            tail = self._map[offset:]
+            merged = sorted(new + [tail[i:i + self._RECORD.size] for i in range(0, len(tail), self._RECORD.size)],
+                            key=_time)
+            # Replaced rather than rewritten in place, since the old file is still mapped.
+            with replace_atomically(self._path) as archive:
+                archive.write(self._map[:offset])
+                archive.write(b''.join(merged))
+        self._open()
+        return len(new)
+
+    def _rows(self, lo: int, hi: int) -> Iterator[tuple]:
+        start = self._HEADER.size + lo * self._RECORD.size
+        return self._RECORD.iter_unpack(memoryview(self._map)[start:self._HEADER.size + hi * self._RECORD.size])
+
+    def _bounds(self, start_time: float = None, end_time: float = None) -> Tuple[int, int]:
+        times = _Times(self)
+        lo = bisect_left(times, int(start_time * 10 ** 9)) if start_time is not None else 0
+        hi = bisect_left(times, int(end_time * 10 ** 9)) if end_time is not None else len(self)
+        return lo, hi
+
+    def rows(self, start_time: float = None, end_time: float = None, market: str = None) -> Iterator[tuple]:
+        """
+        The raw records (see _RECORD) of fills from start_time up to end_time, in seconds since the epoch,
+        for analytics that would rather not build a dict per fill. Use name() for what the ids stand for.
+        """
+        lo, hi = self._bounds(start_time, end_time)
+        rows = self._rows(lo, hi)
+        if market is None:
+            return rows
+        market_id = self._ids.get(market)
+        return (row for row in rows if row[12] == market_id)
+
+    def name(self, symbol_id: int) -> Optional[str]:
+        return self._names[symbol_id]
+
+    def fills(self, start_time: float = None, end_time: float = None, market: str = None) -> Iterator[dict]:
+        """Fills from start_time up to end_time, shaped like FTX's own, with Decimal quantities."""
+        names = self._names
+        for (nanoseconds, fill_id, order_id, trade_id, price, size, fee, fee_rate, price_exponent, size_exponent,
+             fee_exponent, fee_rate_exponent, market_id, base, quote, fee_currency, side, liquidity) \
+                in self.rows(start_time, end_time, market):
+            yield {
+                'id': fill_id, 'market': names[market_id], 'baseCurrency': names[base], 'quoteCurrency': names[quote],
+                'side': _SIDES[side], 'price': Decimal(price).scaleb(price_exponent),
+                'size': Decimal(size).scaleb(size_exponent),
+                'orderId': order_id if order_id >= 0 else None, 'tradeId': trade_id if trade_id >= 0 else None,
+                'time': (_EPOCH + timedelta(microseconds=nanoseconds // 1000)).isoformat(),
+                'feeRate': Decimal(fee_rate).scaleb(fee_rate_exponent), 'fee': Decimal(fee).scaleb(fee_exponent),
+                'feeCurrency': names[fee_currency], 'liquidity': _LIQUIDITIES[liquidity],
+            }
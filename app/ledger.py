@@ -0,0 +1,541 @@
+import os
+import heapq
+import json
+import sys
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from datetime import timedelta
+from decimal import Decimal, Context
+from metrics import metrics
+from atomicfile import replace_atomically
+
+STABLE_USD_COINS = frozenset({'USD', 'USDC', 'TUSD', 'USDP', 'BUSD', 'HUSD'})
+
+# Make all FIAT currency look alike register as one as they are treated all the same, unfortunately, by FTX
+def normalizeCurrency(currency):
+  if currency in STABLE_USD_COINS:
+    return 'USD'
+  else:
+    return currency
+
+
+def intern(name):
+  return sys.intern(name) if name is not None else None
+
+
+# Formatting Decimals is most of the cost of rendering a ledger, and the same prices and sizes turn up over
+# and over again, so formatted quantities are cached. Equal quantities format the same way at a fixed
+# number of places, so the cache can be keyed by value.
+#
+# round gives a quantity as it comes out rendered, for sums that have to agree with what beancount adds up
+# from the text (balance assertions, say).
+class QuantityFormatter:
+  CONTEXT = Context(prec=64)
+
+  def __init__(self, places = 13, cacheSize = 1 << 16):
+    self.spec = '.{0}f'.format(places)
+    self.quantum = Decimal(1).scaleb(-places)
+    self.cacheSize = cacheSize
+    self.cache = {}
+
+  def round(self, quantity):
+    return Decimal(quantity).quantize(self.quantum, context=self.CONTEXT)
+
+  def format(self, quantity):
+    text = self.cache.get(quantity)
+    if text is None:
+      if len(self.cache) >= self.cacheSize:
+        self.cache.clear()
+      text = self.cache[quantity] = format(quantity, self.spec)
+    return text
+
+quantityFormatter = QuantityFormatter()
+formatQuantity = quantityFormatter.format
+roundQuantity = quantityFormatter.round
+
+
+# Entries only stay in memory until runSize of them have piled up. Then they are sorted, rendered and
+# spilled to a temporary file as a sorted run, and write() merges the runs back together. Memory use is
+# bounded by runSize no matter how long the history is.
+#
+# An entry is finished (and may be spilled) once the next entry is added, so add all of an entry's items
+# before moving on to the next one.
+#
+# Sources pass the exchange's raw record for an entry as `raw`; it is appended to the entry's description
+# unless keepRaw is off, in which case it is dropped straight away rather than held in memory. `meta` is
+# written as the entry's metadata, one `key: value` line each.
+#
+# As items are added the ledger keeps track of the date each account and currency is first used and of
+# every account's running balance in each currency, so writing never needs a second pass over the entries.
+# It also keeps the dates each currency was bought or sold on, for which prices can be added with addPrice,
+# and with trackHoldings, every change to what the Assets accounts hold, summed per currency and time.
+#
+# With an accountPrefix, every account gets it inserted after its root, e.g. Assets:Wallet becomes
+# Assets:Trading:Wallet, so that several accounts' ledgers can be merged into one with addLedger.
+#
+# Rendering is pure CPU, so with renderWorkers the entries still in memory when the ledger is written are
+# cut into chunks of renderChunkSize that that many forks of this process render, and the text is taken
+# back in order. The output is the same either way. Forking while other threads run could leave the forks
+# with locks those threads held, so runs spilled while sources are still being read (see runPipeline) are
+# always rendered here, as is anything written while other threads are still about. Handing spilled entries
+# to the workers later instead would mean pickling them, which costs more than rendering them, so render
+# workers only help with what's still in memory: without a runSize of its own, a ledger with renderWorkers
+# keeps up to RENDER_RUN_SIZE entries (about a gigabyte) in memory rather than spilling at RUN_SIZE.
+class Ledger:
+  RUN_SIZE = 100000
+  RENDER_RUN_SIZE = 1000000
+
+  def __init__(self, runSize = None, keepRaw = True, accountPrefix = None, trackHoldings = False,
+               renderWorkers = None, renderChunkSize = 5000):
+    self.runSize = runSize or (self.RENDER_RUN_SIZE if renderWorkers and renderWorkers > 1 else self.RUN_SIZE)
+    self.keepRaw = keepRaw
+    self.accountPrefix = accountPrefix
+    self.entries = []
+    self.runs = []
+    self.accounts = {}
+    self.currencies = {}
+    self.balances = {}
+    self.priceDates = {}
+    self.prices = {}
+    self.holdings = {} if trackHoldings else None
+    self.lastDate = None
+    self.unfinished = None
+    self.renderWorkers = renderWorkers
+    self.renderChunkSize = renderChunkSize
+
+  def addEntry(self, date, description, raw = None, meta = None):
+    self.finishEntry()
+    if len(self.entries) >= self.runSize:
+      self.spill()
+    if self.keepRaw and raw is not None:
+      description = '{0} {1}'.format(description, raw)
+    entry = LedgerEntry(date, description, self, meta)
+    self.entries.append(entry)
+    self.unfinished = entry
+    if self.lastDate is None or date > self.lastDate:
+      self.lastDate = date
+    return entry
+
+  def mapAccount(self, account):
+    if not self.accountPrefix:
+      return account
+    (root, _, rest) = account.partition(':')
+    return ':'.join(part for part in (root, self.accountPrefix, rest) if part)
+
+  def indexItem(self, entry, item):
+    if item.account not in self.accounts or entry.date < self.accounts[item.account]:
+      self.accounts[item.account] = entry.date
+    if item.currency is not None and (item.currency not in self.currencies or entry.date < self.currencies[item.currency]):
+      self.currencies[item.currency] = entry.date
+    if item.quantity is not None:
+      self.addToBalance(item.account, item.currency, roundQuantity(item.quantity), entry.date)
+    if item.inputQuantity is not None or item.price is not None:
+      self.priceDates.setdefault(item.currency, set()).add(entry.date.date())
+
+  def addToBalance(self, account, currency, quantity, date = None):
+    balances = self.balances.setdefault(account, {})
+    balances[currency] = balances.get(currency, 0) + quantity
+    if self.holdings is not None and date is not None and account.startswith('Assets'):
+      changes = self.holdings.setdefault(currency, {})
+      when = date.timestamp()
+      changes[when] = changes.get(when, 0) + quantity
+
+  # An item without a quantity is left for beancount to fill in with whatever balances the entry, in every
+  # currency, so its effect on the balances can only be worked out once the entry has all its items. Like
+  # beancount, this goes by the rendered numbers: an item weighs its cost, or else what it sold for, or
+  # else itself, and what's filled in is rounded to the places the rest are rendered at.
+  def finishEntry(self):
+    entry = self.unfinished
+    self.unfinished = None
+    if entry is None:
+      return
+    elided = [item for item in entry.items if item.quantity is None]
+    if len(elided) != 1:
+      return
+    residuals = {}
+    for item in entry.items:
+      if item.quantity is None:
+        continue
+      quantity = roundQuantity(item.quantity)
+      if item.inputCommodity is not None and item.inputQuantity is not None:
+        (currency, weight) = (item.inputCommodity, quantity * roundQuantity(item.inputQuantity))
+      elif item.priceCommodity is not None and item.price is not None:
+        (currency, weight) = (item.priceCommodity, quantity * roundQuantity(item.price))
+      else:
+        (currency, weight) = (item.currency, quantity)
+      residuals[currency] = residuals.get(currency, 0) - weight
+    for (currency, residual) in residuals.items():
+      residual = roundQuantity(residual)
+      if residual:
+        self.addToBalance(elided[0].account, currency, residual, entry.date)
+
+  def spill(self):
+    self.finishEntry()
+    run = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    with metrics.timer('ledger_spill_seconds'):
+      self.writeRun(run, self.renderPending(parallel=False))
+    run.seek(0)
+    self.runs.append(run)
+    self.entries = []
+
+  def writeRun(self, run, entries):
+    for (key, text) in entries:
+      run.write(json.dumps([key, text]))
+      run.write('\n')
+
+  # Sorts every entry into a single run at path and lets go of them, leaving just the indexes. What's left
+  # can be pickled, say back from a worker process, and merged into another ledger with addLedger.
+  def saveRun(self, path):
+    self.finishEntry()
+    with open(path, 'w', encoding='utf-8') as run:
+      self.writeRun(run, self.getRun())
+    for run in self.runs:
+      run.close()
+    self.runs = []
+    self.entries = []
+
+  def addLedger(self, other, runPath):
+    for (account, date) in other.accounts.items():
+      if account not in self.accounts or date < self.accounts[account]:
+        self.accounts[account] = date
+    for (currency, date) in other.currencies.items():
+      if currency not in self.currencies or date < self.currencies[currency]:
+        self.currencies[currency] = date
+    for (currency, dates) in other.priceDates.items():
+      self.priceDates.setdefault(currency, set()).update(dates)
+    self.prices.update(other.prices)
+    if self.holdings is not None and other.holdings is not None:
+      for (currency, changes) in other.holdings.items():
+        mine = self.holdings.setdefault(currency, {})
+        for (when, quantity) in changes.items():
+          mine[when] = mine.get(when, 0) + quantity
+    for (account, balances) in other.getBalances().items():
+      for (currency, quantity) in balances.items():
+        self.addToBalance(account, currency, quantity)
+    if other.lastDate is not None and (self.lastDate is None or other.lastDate > self.lastDate):
+      self.lastDate = other.lastDate
+    self.runs.append(open(runPath, encoding='utf-8'))
+
+  # Sorted (key, text) pairs for the entries still in memory.
+  def renderPending(self, parallel = True):
+    entries = sorted(self.entries, key=lambda entry: entry.date)
+    if not parallel or not self.renderWorkers or self.renderWorkers < 2 or len(entries) <= self.renderChunkSize \
+        or 'fork' not in multiprocessing.get_all_start_methods() or threading.active_count() > 1:
+      for entry in entries:
+        yield (entry.date.timestamp(), entry.render())
+      return
+    global renderingEntries
+    renderingEntries = entries
+    try:
+      chunks = [(start, start + self.renderChunkSize) for start in range(0, len(entries), self.renderChunkSize)]
+      with multiprocessing.get_context('fork').Pool(self.renderWorkers) as pool:
+        for ((start, stop), texts) in zip(chunks, pool.imap(renderChunk, chunks)):
+          for (entry, text) in zip(entries[start:stop], texts):
+            yield (entry.date.timestamp(), text)
+    finally:
+      renderingEntries = None
+
+  def getAccountsAndCurrencies(self):
+    return (set(self.accounts), set(self.currencies))
+
+  def getBalances(self):
+    self.finishEntry()
+    return self.balances
+
+  # (key, text) for every entry in date order. heapq.merge is stable, so entries with the same date keep
+  # the order they were added in.
+  def getRun(self):
+    # Rewound so that the entries can be read more than once.
+    for run in self.runs:
+      run.seek(0)
+    runs = [(tuple(json.loads(line)) for line in run) for run in self.runs]
+    return heapq.merge(*runs, self.renderPending(), key=lambda run: run[0])
+
+  # Rendered entries in date order.
+  def getEntries(self):
+    for (key, text) in self.getRun():
+      yield text
+
+  def write(self, out, balanceAssertions = False):
+    self.writeHeader(out)
+    for text in self.getEntries():
+      out.write(text)
+    self.writeFooter(out, balanceAssertions)
+
+  def writeHeader(self, out):
+    self.finishEntry()
+    out.write('option "operating_currency" "USD"\n')
+    self.writeDirectives(out)
+
+  # Open and commodity directives, leaving out any whose key is in skip.
+  def writeDirectives(self, out, skip = ()):
+    for (account, date) in sorted(self.accounts.items()):
+      if 'open:' + account not in skip:
+        out.write("{0} open {1}\n".format(date.strftime("%Y-%m-%d"), account))
+
+    for currency in sorted(self.currencies):
+      if 'commodity:' + currency not in skip:
+        out.write(
+        """
+2000-01-01 commodity {currency}
+  price: "USD:coinbase/{currency}-USD"
+  \n""".format(currency = currency))
+
+  def addPrice(self, date, currency, price, priceCommodity):
+    self.prices[(date, currency)] = (price, priceCommodity)
+
+  def writePrices(self, out, skip = ()):
+    for ((date, currency), (price, priceCommodity)) in sorted(self.prices.items()):
+      if 'price:{0}:{1}'.format(date.isoformat(), currency) not in skip:
+        out.write("{0} price {1} {2} {3}\n".format(date.strftime("%Y-%m-%d"), currency, price, priceCommodity))
+
+  def writeFooter(self, out, balanceAssertions = False):
+    self.writePrices(out)
+
+    if balanceAssertions:
+      self.writeBalances(out)
+
+    out.write('plugin "beancount.plugins.unrealized" "Unrealized"\n')
+
+  # Adds whatever isn't in index yet to the ledger at path: open and commodity directives for new accounts
+  # and currencies, the entries, and new prices. The entries should have been filtered against the same
+  # index (LedgerSink does that), and their keys added to it; the index is saved once the ledger is written.
+  # A ledger that doesn't exist yet is written whole.
+  def append(self, path, index):
+    self.finishEntry()
+    if not os.path.exists(path):
+      with open(path, 'w', buffering=1 << 20) as out:
+        self.write(out)
+    else:
+      with open(path, 'a', buffering=1 << 20) as out:
+        self.writeDirectives(out, skip=index)
+        for text in self.getEntries():
+          out.write(text)
+        self.writePrices(out, skip=index)
+    for account in self.accounts:
+      index.add('open:' + account)
+    for currency in self.currencies:
+      index.add('commodity:' + currency)
+    for (date, currency) in self.prices:
+      index.add('price:{0}:{1}'.format(date.isoformat(), currency))
+    index.save(self.lastDate)
+
+  # Writes the entries to one file per year (or per month) in directory and everything else, plus an
+  # include for each of those files, to path. The hash of every file is kept in directory/shards.json, and a
+  # file whose contents hash the same as last time is left alone.
+  def writeShards(self, path, directory, period = 'year', balanceAssertions = False):
+    os.makedirs(directory, exist_ok=True)
+    manifestPath = os.path.join(directory, 'shards.json')
+    try:
+      with open(manifestPath) as manifestFile:
+        manifest = json.load(manifestFile)
+    except (OSError, ValueError):
+      manifest = {}
+    hashes = {}
+
+    # Rendered entries start with their date, YYYY/MM/DD.
+    width = 4 if period == 'year' else 7
+    (name, shard) = (None, None)
+    for text in self.getEntries():
+      if text[:width].replace('/', '-') != name:
+        if shard is not None:
+          hashes[name] = shard.close()
+        name = text[:width].replace('/', '-')
+        shard = ChangedFileWriter(os.path.join(directory, name + '.beancount'), manifest.get(name))
+      shard.write(text)
+    if shard is not None:
+      hashes[name] = shard.close()
+
+    for stale in set(manifest) - set(hashes):
+      try:
+        os.remove(os.path.join(directory, stale + '.beancount'))
+      except OSError:
+        pass
+
+    top = ChangedFileWriter(path, None)
+    self.writeHeader(top)
+    relative = os.path.relpath(directory, os.path.dirname(os.path.abspath(path)))
+    for name in sorted(hashes):
+      top.write('include "{0}"\n'.format(os.path.join(relative, name + '.beancount')))
+    top.write('\n')
+    self.writeFooter(top, balanceAssertions)
+    top.close()
+
+    with open(manifestPath, 'w') as manifestFile:
+      json.dump(hashes, manifestFile, indent=2, sort_keys=True)
+
+  # Balance assertions for every account as of the day after the last entry. Beancount checks an account
+  # together with its subaccounts (Assets:Wallet takes in Assets:Wallet:Interest), so they're rolled up.
+  def writeBalances(self, out):
+    if self.lastDate is None:
+      return
+    date = (self.lastDate + timedelta(days=1)).strftime("%Y-%m-%d")
+    totals = {}
+    for (account, balances) in self.getBalances().items():
+      parts = account.split(':')
+      for end in range(1, len(parts) + 1):
+        parent = ':'.join(parts[:end])
+        if parent not in self.accounts:
+          continue
+        parentTotals = totals.setdefault(parent, {})
+        for (currency, quantity) in balances.items():
+          parentTotals[currency] = parentTotals.get(currency, 0) + quantity
+    for (account, balances) in sorted(totals.items()):
+      for (currency, quantity) in sorted(balances.items()):
+        out.write("{0} balance {1} {2:f} {3}\n".format(date, account, quantity, currency))
+    out.write("\n")
+
+
+# The entries a Ledger's render workers work on. They're forked, so they find the entries already here rather
+# than having them pickled over, which would cost more than rendering them; only the text comes back.
+renderingEntries = None
+
+def renderChunk(bounds):
+  (start, stop) = bounds
+  return [entry.render() for entry in renderingEntries[start:stop]]
+
+
+# The keys of everything already written to a ledger that's appended to (entries, opens, commodities and
+# prices), kept in a file beside it: one key per line, and only ever appended to, so saving costs as much as
+# what was added. Every save also records the date of the newest entry so far.
+class LedgerIndex:
+  def __init__(self, path):
+    self.path = path
+    self.keys = set()
+    self.added = []
+    self.newest = None
+    try:
+      with open(path, encoding='utf-8') as keys:
+        for line in keys:
+          key = line.rstrip('\n')
+          if key.startswith('newest:'):
+            timestamp = float(key[len('newest:'):])
+            self.newest = timestamp if self.newest is None else max(self.newest, timestamp)
+          elif key:
+            self.keys.add(key)
+    except FileNotFoundError:
+      pass
+
+  def __contains__(self, key):
+    return key in self.keys
+
+  def add(self, key):
+    if key not in self.keys:
+      self.keys.add(key)
+      self.added.append(key)
+
+  def save(self, newest = None):
+    with open(self.path, 'a', encoding='utf-8') as keys:
+      for key in self.added:
+        keys.write(key)
+        keys.write('\n')
+      if newest is not None:
+        keys.write('newest:{0!r}\n'.format(newest.timestamp()))
+    if newest is not None and (self.newest is None or newest.timestamp() > self.newest):
+      self.newest = newest.timestamp()
+    self.added = []
+
+
+# Collects a file's new contents (in memory, unless there's a lot of them) and only replaces the file if
+# they hash differently from previousHash. With no previousHash, the file on disk is hashed instead.
+class ChangedFileWriter:
+  def __init__(self, path, previousHash):
+    self.path = path
+    self.previousHash = previousHash
+    self.hash = hashlib.sha256()
+    self.buffer = tempfile.SpooledTemporaryFile(max_size=64 << 20)
+
+  def write(self, text):
+    data = text.encode('utf-8')
+    self.hash.update(data)
+    self.buffer.write(data)
+
+  def close(self):
+    digest = self.hash.hexdigest()
+    previousHash = self.previousHash
+    if previousHash is None and os.path.exists(self.path):
+      with open(self.path, 'rb') as existing:
+        previousHash = hashlib.sha256(existing.read()).hexdigest()
+    if digest != previousHash or not os.path.exists(self.path):
+      self.buffer.seek(0)
+      with replace_atomically(self.path) as out:
+        while True:
+          data = self.buffer.read(1 << 20)
+          if not data:
+            break
+          out.write(data)
+    self.buffer.close()
+    return digest
+
+
+# There are millions of these, so they use __slots__ rather than a __dict__ each, and the handful of
+# distinct account and currency names are interned so that every item shares the same string objects.
+class LedgerEntry:
+  __slots__ = ('date', 'description', 'items', 'ledger', 'meta')
+
+  class Item:
+    __slots__ = ('currency', 'account', 'quantity', 'description', 'inputCommodity', 'inputQuantity', 'lotDate', 'price', 'priceCommodity')
+
+    # lotDate picks out a particular lot when reducing a position; price is what the units sold for.
+    def __init__(self, account, currency, quantity, inputCommodity, inputQuantity, description, lotDate = None, price = None, priceCommodity = None):
+      self.currency = intern(normalizeCurrency(currency))
+      self.account = intern(account) #"{account}:{currency}".format(account = account, currency = self.currency)
+      self.quantity = quantity
+      self.description = description
+      self.inputCommodity = intern(normalizeCurrency(inputCommodity))
+      self.inputQuantity = inputQuantity
+      self.lotDate = lotDate
+      self.price = price
+      self.priceCommodity = intern(normalizeCurrency(priceCommodity))
+
+    def generateCostBasisText(self):
+      if self.inputCommodity == None or self.inputQuantity == None:
+        return ""
+      if self.lotDate is not None:
+        return '{{{0} {1}, {2}}}'.format(formatQuantity(self.inputQuantity), self.inputCommodity, self.lotDate.strftime("%Y-%m-%d"))
+      return '{{{0} {1}}}'.format(formatQuantity(self.inputQuantity), self.inputCommodity)
+
+    def generatePriceText(self):
+      return "" if (self.priceCommodity == None or self.price == None) else ' @ {0} {1}'.format(formatQuantity(self.price), self.priceCommodity)
+
+    def generateDescriptionComment(self):
+      return ';; {0}'.format(self.description) if self.description else ''
+
+
+    # NB: The precision here is hack; it should really be based on the known precision; i had to force it here to get rid of scientific notation because beancounter doesn't understand it.
+    def __repr__(self):
+      if (self.currency == None or self.quantity == None):
+        return "{account}\t{comment}".format(account=self.account, comment = self.generateDescriptionComment())
+      else:
+        return "{0}\t{1} {2} {3}{4} {5}".format(self.account, formatQuantity(self.quantity), self.currency, self.generateCostBasisText(), self.generatePriceText(), self.generateDescriptionComment())
+
+
+  def __init__(self, date, description, ledger = None, meta = None):
+    self.date = date
+    self.description = description
+    self.items = []
+    self.ledger = ledger
+    self.meta = meta
+
+  def addItem(self, account, currency = None, quantity = None, inputCommodity = None, inputQuantity = None, description = '',
+              lotDate = None, price = None, priceCommodity = None):
+    if self.ledger is not None:
+      account = self.ledger.mapAccount(account)
+    item = self.Item(account=account, currency=currency, quantity=quantity,
+                     inputCommodity=inputCommodity, inputQuantity=inputQuantity, description=description,
+                     lotDate=lotDate, price=price, priceCommodity=priceCommodity)
+    self.items.append(item)
+    if self.ledger is not None:
+      self.ledger.indexItem(self, item)
+
+  def render(self):
+    lines = ['{0} * "{1}"\n'.format(self.date.strftime("%Y/%m/%d"), self.description)]
+    if self.meta:
+      for (key, value) in self.meta.items():
+        lines.append('  {0}: {1}\n'.format(key, json.dumps(value) if isinstance(value, str) else value))
+    for item in self.items:
+      lines.append("  {}\n".format(item))
+    lines.append("\n")
+    return ''.join(lines)
@@ -0,0 +1,171 @@
+import heapq
+from collections import deque
+
+# Matches disposals against the lots they came out of so that realized gains can be computed by the
+# exporter itself rather than left for beancount to book. Each currency has its own queue of open lots,
+# ordered for the booking method, so matching a fill is a few deque or heap operations however long the
+# history is:
+#
+#   FIFO      oldest lot first
+#   LIFO      newest lot first
+#   HIFO      most expensive lot first, among lots that cost what the disposal is for (see HifoLots)
+#   SPECIFIC  the lot named by lotId, then oldest first for whatever is left over
+#
+# selections maps what's being disposed of to the lot it's to come out of, for SPECIFIC booking (the
+# exporter keys it by the ids of sell fills, and names lots by the ids of the fills that bought them).
+#
+# Fills must be fed in time order.
+class Lot:
+  __slots__ = ('date', 'quantity', 'cost', 'costCurrency', 'lotId')
+
+  def __init__(self, date, quantity, cost, costCurrency, lotId = None):
+    self.date = date
+    self.quantity = quantity
+    self.cost = cost
+    self.costCurrency = costCurrency
+    self.lotId = lotId
+
+
+# One lot (or part of one) given up by a disposal. lot is None for any quantity that was sold without
+# there being a lot to match it against.
+class Disposal:
+  __slots__ = ('lot', 'quantity', 'proceeds', 'proceedsCurrency')
+
+  def __init__(self, lot, quantity, proceeds, proceedsCurrency):
+    self.lot = lot
+    self.quantity = quantity
+    self.proceeds = proceeds
+    self.proceedsCurrency = proceedsCurrency
+
+  # None when the lot was bought in a different currency than it was sold for, since there's no price here
+  # to convert between them.
+  def getGain(self):
+    if self.lot is None or self.lot.costCurrency != self.proceedsCurrency:
+      return None
+    return self.quantity * (self.proceeds - self.lot.cost)
+
+
+class FifoLots:
+  def __init__(self):
+    self.lots = deque()
+
+  def add(self, lot):
+    self.lots.append(lot)
+
+  # currency is what the disposal is for, which only HifoLots needs to know.
+  def peek(self, currency = None):
+    return self.lots[0] if self.lots else None
+
+  def pop(self):
+    self.lots.popleft()
+
+
+class LifoLots(FifoLots):
+  def peek(self, currency = None):
+    return self.lots[-1] if self.lots else None
+
+  def pop(self):
+    self.lots.pop()
+
+
+# Costs in different currencies can't be compared without a price to convert between them, so each cost
+# currency has a heap of its own. A disposal comes out of the most expensive lots that cost what it's for,
+# and only once those run out from the other currencies' most expensive lots, earliest bought first.
+class HifoLots:
+  def __init__(self):
+    self.heaps = {}
+    self.count = 0
+    self.top = None
+
+  def add(self, lot):
+    # The count keeps equally priced lots in the order they were bought.
+    heapq.heappush(self.heaps.setdefault(lot.costCurrency, []), (-lot.cost, self.count, lot))
+    self.count += 1
+
+  def peek(self, currency = None):
+    heap = self.heaps.get(currency)
+    if not heap:
+      heap = min((heap for heap in self.heaps.values() if heap), key=lambda heap: heap[0][1], default=None)
+    self.top = heap
+    return heap[0][2] if heap else None
+
+  # Takes out the lot the last peek returned.
+  def pop(self):
+    heapq.heappop(self.top)
+
+
+# Oldest first, but any lot can be taken out by id. Lots taken out of the middle are only marked empty and
+# skipped when they reach the front.
+class SpecificLots(FifoLots):
+  def __init__(self):
+    FifoLots.__init__(self)
+    self.byId = {}
+
+  def add(self, lot):
+    FifoLots.add(self, lot)
+    if lot.lotId is not None:
+      self.byId[lot.lotId] = lot
+
+  def find(self, lotId):
+    lot = self.byId.get(lotId)
+    return lot if lot is not None and lot.quantity > 0 else None
+
+  def peek(self, currency = None):
+    while self.lots and self.lots[0].quantity <= 0:
+      self.lots.popleft()
+    return FifoLots.peek(self, currency)
+
+  def pop(self):
+    lot = self.lots.popleft()
+    self.byId.pop(lot.lotId, None)
+
+
+class LotBook:
+  METHODS = {'FIFO': FifoLots, 'LIFO': LifoLots, 'HIFO': HifoLots, 'SPECIFIC': SpecificLots}
+
+  def __init__(self, method = 'FIFO', selections = None):
+    self.queue = self.METHODS[method]
+    self.lots = {}
+    self.selections = selections or {}
+
+  def acquire(self, currency, quantity, cost, costCurrency, date, lotId = None):
+    lots = self.lots.get(currency)
+    if lots is None:
+      lots = self.lots[currency] = self.queue()
+    lot = Lot(date, quantity, cost, costCurrency, lotId)
+    lots.add(lot)
+    return lot
+
+  def dispose(self, currency, quantity, proceeds, proceedsCurrency, lotId = None):
+    lots = self.lots.get(currency)
+    disposals = []
+    if lots is not None and lotId is not None and isinstance(lots, SpecificLots):
+      lot = lots.find(lotId)
+      if lot is not None:
+        matched = min(quantity, lot.quantity)
+        lot.quantity -= matched
+        quantity -= matched
+        disposals.append(Disposal(Lot(lot.date, matched, lot.cost, lot.costCurrency, lot.lotId), matched, proceeds, proceedsCurrency))
+    while quantity > 0 and lots is not None:
+      lot = lots.peek(proceedsCurrency)
+      if lot is None:
+        break
+      matched = min(quantity, lot.quantity)
+      lot.quantity -= matched
+      quantity -= matched
+      if lot.quantity <= 0:
+        lots.pop()
+      disposals.append(Disposal(Lot(lot.date, matched, lot.cost, lot.costCurrency, lot.lotId), matched, proceeds, proceedsCurrency))
+    if quantity > 0:
+      disposals.append(Disposal(None, quantity, proceeds, proceedsCurrency))
+    return disposals
+
+  # What's left of every open lot of currency, in the order they'd be matched (for HIFO, each cost
+  # currency's lots in turn).
+  def getLots(self, currency):
+    lots = self.lots.get(currency)
+    if lots is None:
+      return []
+    if isinstance(lots, HifoLots):
+      return [lot for costCurrency in sorted(lots.heaps) for (_, _, lot) in sorted(lots.heaps[costCurrency])]
+    return [lot for lot in (reversed(lots.lots) if isinstance(lots, LifoLots) else lots.lots) if lot.quantity > 0]
@@ -0,0 +1,169 @@
+import os
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+from atomicfile import replace_atomically
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics:
+    """
+    Counters and timers, each named and optionally labelled (say by endpoint), safe to update from any
+    thread. A timer keeps the number of observations, their total and their maximum.
+
+    stage() times a whole stage of an export and, when profile_dir is set, profiles it with cProfile into
+    profile_dir/<stage>.prof; with trace_memory it also records the stage's peak traced memory.
+
+    snapshot() is a plain copy that can be sent back from a worker process and merge()d into another.
+    """
+
+    def __init__(self, profile_dir: str = None, trace_memory: bool = False) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[_Key, float] = {}
+        self._timers: Dict[_Key, list] = {}
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> _Key:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, count: int = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                self._timers[key] = [count, seconds, seconds]
+            else:
+                timer[0] += count
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name: str, records: Iterable, **labels) -> Iterator:
+        """
+        Passes records through, counting them and timing how long it took to produce them (not how long
+        whoever reads them spends on each one). One observation covers the whole iteration.
+        """
+        spent = 0.0
+        count = 0
+        iterator = iter(records)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    record = next(iterator)
+                except StopIteration:
+                    spent += time.perf_counter() - started
+                    break
+                spent += time.perf_counter() - started
+                count += 1
+                yield record
+        finally:
+            self.observe(name, spent, count=0, **labels)
+            self.count(name.replace('_seconds', '_records_total'), count, **labels)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        profile = None
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile = cProfile.Profile()
+            profile.enable()
+        # Stages don't nest, but whatever started tracing first is left to stop it.
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            with self.timer('stage_seconds', stage=name):
+                yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+            if tracing:
+                self.count('stage_peak_traced_bytes', tracemalloc.get_traced_memory()[1], stage=name)
+                tracemalloc.stop()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'counters': dict(self._counters), 'timers': {key: list(timer) for key, timer in self._timers.items()}}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        for (name, labels), value in snapshot['counters'].items():
+            self.count(name, value, **dict(labels))
+        for (name, labels), (count, total, longest) in snapshot['timers'].items():
+            key = (name, labels)
+            with self._lock:
+                timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+
+    @staticmethod
+    def _name(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def summary(self) -> str:
+        """One line per counter and timer, sorted by name and labels."""
+        snapshot = self.snapshot()
+        lines = []
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            lines.append(f'{self._name(name, labels)} {value:.15g}')
+        for (name, labels), (count, total, longest) in sorted(snapshot['timers'].items()):
+            line = f'{self._name(name, labels)} total={total:.3f}s'
+            if count:
+                line += f' count={count} mean={total / count * 1000:.1f}ms max={longest * 1000:.1f}ms'
+            lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Write everything in the Prometheus text format, for node_exporter's textfile collector. Timers
+        become summaries (_count and _sum); the file is replaced whole so it's never read half-written.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}')
+            lines.append(f'{self._name(name, labels)} {value:.15g}')
+        for (name, labels), (count, total, longest) in sorted(snapshot['timers'].items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} summary')
+            lines.append(f'{self._name(name + "_sum", labels)} {total:.6f}')
+            if count:
+                lines.append(f'{self._name(name + "_count", labels)} {count}')
+        with replace_atomically(path, 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+
+
+# What everything reports to unless it's given a Metrics of its own.
+metrics = Metrics()
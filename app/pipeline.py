@@ -0,0 +1,125 @@
+import time
+import queue
+import threading
+from metrics import metrics
+
+# An export is a pipeline: sources fetch the exchange's records, each source's stages turn them into
+# Transactions one at a time, and a sink (normally a LedgerSink) takes the transactions.
+#
+# Every source runs in a thread of its own, so a slow one (fills, paging through years of history) overlaps
+# with the others. The sink is only ever fed from the calling thread and takes the sources in the order
+# they're given, each in its own order, so the output is the same as running them one after the other.
+# Transactions from the sources still to come wait in their source's buffer until their turn, and a full
+# buffer holds up its source.
+#
+# A stage is a function from an iterator of records to an iterator of records (usually a generator), and
+# the last stage of a source has to produce Transactions.
+#
+# Each source reports how long fetching took (source_fetch_seconds) apart from fetching and its stages
+# together (source_seconds), and how long the sink spent on its transactions (sink_seconds).
+
+
+# key identifies what a transaction came from (say 'fill:63820377') for as long as the exchange keeps it.
+# meta becomes the entry's metadata.
+class Transaction:
+  __slots__ = ('date', 'description', 'raw', 'postings', 'key', 'meta')
+
+  def __init__(self, date, description, raw = None, key = None, meta = None):
+    self.date = date
+    self.description = description
+    self.raw = raw
+    self.postings = []
+    self.key = key
+    self.meta = meta
+
+  # Takes the arguments of LedgerEntry.addItem.
+  def addPosting(self, **posting):
+    self.postings.append(posting)
+    return self
+
+
+class Source:
+  def __init__(self, name, fetch, *stages):
+    self.name = name
+    self.fetch = fetch
+    self.stages = stages
+
+  def records(self):
+    records = metrics.timed('source_fetch_seconds', self.fetch(), source=self.name)
+    for stage in self.stages:
+      records = stage(records)
+    return metrics.timed('source_seconds', records, source=self.name)
+
+
+# With an index (a LedgerIndex, or anything else with `in` and add), transactions whose keys are in it are
+# dropped and the keys of the rest are added to it. Keys are qualified by the ledger's account prefix, since
+# interest payments, say, are only unique within an account.
+class LedgerSink:
+  def __init__(self, ledger, index = None):
+    self.ledger = ledger
+    self.index = index
+
+  def add(self, transaction):
+    if self.index is not None and transaction.key is not None:
+      key = transaction.key if not self.ledger.accountPrefix else '{0}/{1}'.format(self.ledger.accountPrefix, transaction.key)
+      if key in self.index:
+        metrics.count('sink_skipped_total')
+        return
+      self.index.add(key)
+    entry = self.ledger.addEntry(transaction.date, transaction.description, raw=transaction.raw, meta=transaction.meta)
+    for posting in transaction.postings:
+      entry.addItem(**posting)
+
+  def close(self):
+    self.ledger.finishEntry()
+
+
+# What a source's thread puts in its buffer after its last transaction, with the exception it died of, if any.
+class EndOfSource:
+  def __init__(self, error = None):
+    self.error = error
+
+
+def runSource(source, buffer, stopped):
+  try:
+    for transaction in source.records():
+      while True:
+        try:
+          buffer.put(transaction, timeout=0.1)
+          break
+        except queue.Full:
+          if stopped.is_set():
+            return
+    buffer.put(EndOfSource())
+  except BaseException as error:
+    buffer.put(EndOfSource(error))
+
+
+def runPipeline(sources, sink, bufferSize = 100000):
+  buffers = [queue.Queue(maxsize=bufferSize) for _ in sources]
+  stopped = threading.Event()
+  threads = [threading.Thread(target=runSource, args=(source, buffer, stopped), name=source.name, daemon=True)
+             for (source, buffer) in zip(sources, buffers)]
+  for thread in threads:
+    thread.start()
+  try:
+    for (source, buffer) in zip(sources, buffers):
+      spent = 0.0
+      while True:
+        transaction = buffer.get()
+        if isinstance(transaction, EndOfSource):
+          if transaction.error is not None:
+            raise transaction.error
+          break
+        started = time.perf_counter()
+        sink.add(transaction)
+        spent += time.perf_counter() - started
+      metrics.observe('sink_seconds', spent, count=0, source=source.name)
+  finally:
+    # Sources still running give up once their buffer fills.
+    stopped.set()
+  # Every source has finished by now; waiting for their threads to go means nothing is left running
+  # alongside whatever comes next (say a ledger forking to render).
+  for thread in threads:
+    thread.join()
+  sink.close()
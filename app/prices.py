@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import mmap
+import array
+from bisect import bisect_right
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from atomicfile import replace_atomically
+
+
+class PriceStore:
+    """
+    Closing prices of candles, one pair of files per market and resolution: `.times` holds each candle's
+    start time in seconds and `.closes` its close, both as packed native 8-byte numbers in time order. The
+    columns are memory-mapped when read, so looking up a price is a binary search over the mapped times
+    however many candles there are, and nothing is parsed.
+
+    update() only fetches what is missing: candles after the newest one stored and, if start_time is
+    earlier than anything stored, candles before the oldest one. Since nothing stored is fetched again, a
+    candle is only stored once it has closed.
+    """
+
+    def __init__(self, directory: str, resolution: int = 24 * 60 * 60) -> None:
+        self._directory = directory
+        self._resolution = resolution
+        self._columns: Dict[str, Tuple[memoryview, memoryview]] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, market: str, column: str) -> str:
+        name = re.sub('[^A-Za-z0-9-]+', '_', market)
+        return os.path.join(self._directory, f'{name}.{self._resolution}.{column}')
+
+    def _map(self, path: str, typecode: str) -> memoryview:
+        with open(path, 'rb') as column:
+            if os.fstat(column.fileno()).st_size == 0:
+                return memoryview(array.array(typecode))
+            # The mapping stays valid after the file is closed.
+            return memoryview(mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+    def _get_columns(self, market: str) -> Tuple[memoryview, memoryview]:
+        columns = self._columns.get(market)
+        if columns is None:
+            try:
+                columns = (self._map(self._path(market, 'times'), 'q'), self._map(self._path(market, 'closes'), 'd'))
+            except FileNotFoundError:
+                columns = (memoryview(array.array('q')), memoryview(array.array('d')))
+            self._columns[market] = columns
+        return columns
+
+    def _write(self, market: str, candles: Iterable[Tuple[int, float]], append: bool) -> None:
+        times = array.array('q')
+        closes = array.array('d')
+        for (time, close) in candles:
+            times.append(time)
+            closes.append(close)
+        self._columns.pop(market, None)
+        for (column, values) in (('times', times), ('closes', closes)):
+            path = self._path(market, column)
+            if append:
+                with open(path, 'ab') as out:
+                    values.tofile(out)
+                continue
+            # Replaced rather than truncated, since the old file may still be mapped.
+            with replace_atomically(path) as out:
+                values.tofile(out)
+
+    def update(self, fetch: Callable[[str, int, float, float], Iterable[dict]], market: str,
+               start_time: float, end_time: float, now: float = None) -> int:
+        """
+        Fill in the closed candles (as of `now`) of market between start_time and end_time with
+        fetch(market, resolution, start_time, end_time), which yields the exchange's candles oldest first.
+        Returns how many were added.
+        """
+        closed_before = (now if now is not None else time.time()) - self._resolution
+        times, closes = self._get_columns(market)
+        added = 0
+        if len(times) and start_time < times[0]:
+            # Candles are only ever appended, so older ones mean rewriting the columns.
+            older = [(int(candle['time'] // 1000), candle['close'])
+                     for candle in fetch(market, self._resolution, start_time, times[0] - 1)]
+            older = [candle for candle in older if candle[0] < times[0] and candle[0] <= closed_before]
+            if older:
+                self._write(market, older + list(zip(times, closes)), append=False)
+                added += len(older)
+            times, closes = self._get_columns(market)
+        first = times[-1] + self._resolution if len(times) else start_time
+        if first < end_time:
+            newest = times[-1] if len(times) else None
+            newer = [(int(candle['time'] // 1000), candle['close'])
+                     for candle in fetch(market, self._resolution, first, end_time)]
+            newer = [candle for candle in newer if (newest is None or candle[0] > newest) and candle[0] <= closed_before]
+            self._write(market, newer, append=True)
+            added += len(newer)
+        return added
+
+    @property
+    def resolution(self) -> int:
+        """Seconds per candle."""
+        return self._resolution
+
+    def columns(self, market: str) -> Tuple[memoryview, memoryview]:
+        """The start times and closes of every candle of market, in time order."""
+        return self._get_columns(market)
+
+    def price(self, market: str, when: float) -> Optional[Decimal]:
+        """The close of the last candle of market that started at or before `when`."""
+        times, closes = self._get_columns(market)
+        i = bisect_right(times, when) - 1
+        if i < 0:
+            return None
+        return Decimal(repr(closes[i]))
@@ -0,0 +1,87 @@
+import os
+import time
+import gzip
+import json
+import hashlib
+from typing import Optional, Dict, Any
+
+from atomicfile import replace_atomically
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+    """
+    Raw API responses on disk, gzipped and addressed by a hash of the endpoint and its parameters.
+
+    A response is reused until it is older than the TTL of the longest matching endpoint prefix in `ttls`
+    (or `ttl` if none match; None never expires). In offline mode every response is reused however old it
+    is, and a request that was never recorded raises CacheMiss instead of going to the exchange.
+
+    A history request whose window had already closed when it was recorded (its `end_time` was more than
+    `settle` seconds before then) never expires either: nothing more can turn up in it.
+
+    History requests are bounded by "now", so the cache also remembers the "now" it handed out and keeps
+    handing out the same one until it is older than `ttl`; until then a re-run makes exactly the same
+    requests as the run that filled the cache, and offline replay always does.
+    """
+
+    def __init__(self, directory: str, ttl: Optional[float] = 60 * 60, ttls: Dict[str, Optional[float]] = None,
+                 offline: bool = False, settle: float = 24 * 60 * 60) -> None:
+        self._directory = directory
+        self._ttl = ttl
+        self._ttls = ttls or {}
+        self._settle = settle
+        self._offline = offline
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, endpoint: str, params: Any) -> str:
+        # Requests leaves out parameters that are None, so they don't make for a different request.
+        if isinstance(params, dict):
+            params = {key: value for key, value in params.items() if value is not None}
+        key = hashlib.sha256(json.dumps([endpoint, params], sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self._directory, key[:2], key + '.gz')
+
+    def _ttl_for(self, endpoint: str) -> Optional[float]:
+        matches = [prefix for prefix in self._ttls if endpoint.startswith(prefix)]
+        return self._ttls[max(matches, key=len)] if matches else self._ttl
+
+    def _write(self, path: str, content: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with replace_atomically(path) as out:
+            out.write(content)
+
+    def get(self, endpoint: str, params: Any = None, end_time: float = None) -> Optional[bytes]:
+        path = self._path(endpoint, params)
+        try:
+            recorded = os.path.getmtime(path)
+        except OSError:
+            if self._offline:
+                raise CacheMiss(f'{endpoint} {params} was never recorded')
+            return None
+        ttl = self._ttl_for(endpoint)
+        closed = end_time is not None and float(end_time) < recorded - self._settle
+        if not self._offline and not closed and ttl is not None and time.time() - recorded > ttl:
+            return None
+        with open(path, 'rb') as cached:
+            return gzip.decompress(cached.read())
+
+    def put(self, endpoint: str, params: Any, content: bytes) -> None:
+        if not self._offline:
+            self._write(self._path(endpoint, params), gzip.compress(content))
+
+    def now(self) -> float:
+        path = os.path.join(self._directory, 'now')
+        try:
+            with open(path) as clock:
+                now = float(clock.read())
+        except (OSError, ValueError):
+            if self._offline:
+                raise CacheMiss('nothing has been recorded yet')
+            now = None
+        if not self._offline and (now is None or (self._ttl is not None and time.time() - now > self._ttl)):
+            now = time.time()
+            self._write(path, repr(now).encode())
+        return now
@@ -0,0 +1,303 @@
+import sys
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, Context, ROUND_DOWN, ROUND_HALF_UP
+from itertools import islice
+from ledger import normalizeCurrency
+from pipeline import Transaction
+
+# Pipeline stages that turn FTX's history records into transactions. Sources of other shapes (say ccxt's
+# unified trades) get a stage of their own in front that turns them into these.
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+# Sells are matched against the lots they came out of and the gain on each lot is realized. Whatever can't
+# be matched (say it came from a deposit, which has no cost) is left for beancount to book. With SPECIFIC
+# booking, the book's selections can name the lot (by the id of the fill that bought it) a sell comes out of.
+#
+# A lot bought in another currency than it's sold for (ETH bought on ETH/BTC and sold on ETH/USD, say)
+# weighs in at its cost and can't carry the sale price, so the proceeds are posted to the wallet explicitly
+# and the gain is realized in both currencies: the proceeds as income, less the cost. There's no price here
+# to net them into one.
+def addSale(transaction, book, fill, size, price):
+  quoteCurrency = normalizeCurrency(fill['quoteCurrency'])
+  lotId = book.selections.get(str(fill['id']))
+  for disposal in book.dispose(fill['baseCurrency'], size, price, quoteCurrency, lotId=lotId):
+    lot = disposal.lot
+    if lot is None:
+      eprint("fill({id}): no lot to sell {quantity} {currency} from".format(id = fill['id'], quantity = disposal.quantity, currency = fill['baseCurrency']))
+      transaction.addPosting(account="Assets:Wallet", currency=fill['baseCurrency'], quantity=-disposal.quantity,
+                             price=price, priceCommodity=quoteCurrency, description="Sale")
+      continue
+    gain = disposal.getGain()
+    # beancount won't have a price in another currency than the cost.
+    transaction.addPosting(account="Assets:Wallet", currency=fill['baseCurrency'], quantity=-disposal.quantity,
+                           inputCommodity=lot.costCurrency, inputQuantity=lot.cost, lotDate=lot.date,
+                           price=price if gain is not None else None, priceCommodity=quoteCurrency, description="Sale")
+    if gain is None:
+      proceeds = disposal.quantity * price
+      transaction.addPosting(account="Assets:Wallet", currency=quoteCurrency, quantity=proceeds)
+      transaction.addPosting(account="Income:Gains", currency=quoteCurrency, quantity=-proceeds)
+      transaction.addPosting(account="Income:Gains", currency=lot.costCurrency, quantity=disposal.quantity * lot.cost)
+    elif gain:
+      transaction.addPosting(account="Income:Gains", currency=quoteCurrency, quantity=-gain)
+
+# With a book, a fee in anything but the quote currency comes out of lots just like a sale, and goes to
+# Expenses:Fees at what those lots cost, so that beancount reduces the same lots the book does.
+def addFee(transaction, book, fill, fee, description):
+  for disposal in book.dispose(fill['feeCurrency'], fee, None, None):
+    lot = disposal.lot
+    if lot is None:
+      transaction.addPosting(account="Expenses:Fees", currency=fill['feeCurrency'], quantity=disposal.quantity, description=description)
+      transaction.addPosting(account="Assets:Wallet", currency=fill['feeCurrency'], quantity=-disposal.quantity)
+      continue
+    transaction.addPosting(account="Expenses:Fees", currency=fill['feeCurrency'], quantity=disposal.quantity,
+                           inputCommodity=lot.costCurrency, inputQuantity=lot.cost, description=description)
+    transaction.addPosting(account="Assets:Wallet", currency=fill['feeCurrency'], quantity=-disposal.quantity,
+                           inputCommodity=lot.costCurrency, inputQuantity=lot.cost, lotDate=lot.date)
+
+# The way that FTX does charges is as follows
+# Say you by 1 BTC for 1000 USD and your Maker fee is 1%
+# You will be 0.01 BTC (BTC because is Maker fee).
+# So you will debit 1000 USD to bay for 1 BTC
+# Then you will debit 0.1 BTC for yoru feel
+# You will then have 0.99 BTC @ 1000 USD and -1000 USD in your accounts
+#
+# With a book, sells are booked against it, and a fee taken in the base currency of a buy comes straight out
+# of what was bought: only the rest is held as a lot, and the fee is held at the fill's price. With
+# feeAtCost, a fee in anything but the quote currency is held at the fill's price.
+def fillTransactions(book = None, feeAtCost = False):
+  def stage(fills):
+    #  {'id': 63820377, 'market': 'SOL/USD', 'future': None, 'baseCurrency': 'SOL', 'quoteCurrency': 'USD',
+    # 'type': 'order', 'side': 'buy', 'price': 89.7775, 'size': 15.0, 'orderId': 4216671021,
+    # 'time': '2022-03-21T13:54:26.393415+00:00', 'tradeId': 27130489, 'feeRate': 0.0008, 'fee': 0.012,
+    # 'feeCurrency': 'SOL', 'liquidity': 'maker'}
+    for fill in fills:
+      transaction = Transaction(datetime.fromisoformat(fill['time']), "fillid-{0}: {1} {2} {3} @ {4} {5} ea.".format(
+          fill['id'], fill['side'], fill['size'], fill['baseCurrency'], fill['price'], fill['quoteCurrency']), raw=fill,
+          key='fill:{0}'.format(fill['id']))
+      size = Decimal(str(fill['size']))
+      price = Decimal(str(fill['price']))
+      fee = Decimal(str(fill['fee']))
+      feeDescription = 'Fee rate of {feeRate} as {makerOrTaker}'.format(feeRate= fill['feeRate'], makerOrTaker = fill['liquidity'])
+      feeFromPurchase = False
+      if book is not None and fill['side'] == 'sell':
+        addSale(transaction, book, fill, size, price)
+      else:
+        feeFromPurchase = book is not None and fill['feeCurrency'] == fill['baseCurrency']
+        bought = size - fee if feeFromPurchase else size
+        transaction.addPosting(account="Assets:Wallet",
+                               currency=fill['baseCurrency'], quantity=bought, inputCommodity=fill['quoteCurrency'], inputQuantity=price, description="Purchase")
+        if book is not None:
+          book.acquire(fill['baseCurrency'], bought, price, normalizeCurrency(fill['quoteCurrency']), transaction.date, lotId=str(fill['id']))
+
+      if book is not None and fee and not feeFromPurchase and normalizeCurrency(fill['feeCurrency']) != normalizeCurrency(fill['quoteCurrency']):
+        addFee(transaction, book, fill, fee, feeDescription)
+      elif (feeAtCost or feeFromPurchase) and fill['quoteCurrency'] != fill['feeCurrency']:
+        transaction.addPosting(account="Expenses:Fees", currency=fill['feeCurrency'], quantity=fee, inputCommodity=fill['quoteCurrency'], inputQuantity=price, description=feeDescription)
+      else:
+        transaction.addPosting(account="Expenses:Fees", currency=fill['feeCurrency'], quantity=fee, description=feeDescription)
+      transaction.addPosting(account="Assets:Wallet", currency=fill['feeCurrency'])
+      yield transaction
+  return stage
+
+# Passes fills through unchanged, adding them to a FillArchive a batch at a time on the way.
+def archiveFills(archive, batchSize = 10000):
+  def stage(fills):
+    batch = []
+    for fill in fills:
+      batch.append(fill)
+      if len(batch) >= batchSize:
+        archive.append(batch)
+        batch = []
+      yield fill
+    archive.append(batch)
+  return stage
+
+def depositTransactions(deposits):
+  for deposit in deposits:
+    if deposit['size'] != None:
+      currency = deposit['coin']
+      quantity = Decimal(str(deposit['size']))
+      transaction = Transaction(
+        date = datetime.fromisoformat(deposit['time']),
+        description = 'Deposit {0} {1}'.format(quantity, currency),
+        key = 'deposit:{0}'.format(deposit['id']))
+      transaction.addPosting(
+        account = 'Assets:Wallet',
+        currency = currency,
+        quantity = quantity,
+        description = '')
+      transaction.addPosting(
+        account = 'Income:Investments',
+        currency=currency,
+        quantity = -quantity,
+        description='')
+      yield transaction
+
+INTEREST_PERIODS = ('day', 'week', 'month')
+
+# The start of the period (in UTC) that time falls in. Weeks start on Monday, but a week that straddles the
+# new year is split in two, so that no period spans two (tax) years.
+def periodStart(time, period):
+  day = time.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+  if period == 'week':
+    return max(day - timedelta(days=day.weekday()), day.replace(month=1, day=1))
+  if period == 'month':
+    return day.replace(day=1)
+  return day
+
+# Interest is paid every hour, in every coin, which makes for a lot of tiny entries. This stage goes in
+# front of lendingTransactions or borrowTransactions and rolls the payments up into one per coin for each
+# period, summing `field` (proceeds or cost) exactly. The result has the payment's shape, dated at the last
+# payment it takes in (so nothing is booked before it was paid), plus the period, when it started and the
+# number of payments it stands for.
+#
+# The whole history is rolled up before anything comes out, which is fine: there are only so many coins
+# and periods.
+def interestBuckets(period, field):
+  def stage(payments):
+    buckets = {}
+    for payment in payments:
+      time = datetime.fromisoformat(payment['time'])
+      key = (periodStart(time, period), payment['coin'])
+      bucket = buckets.get(key)
+      if bucket is None:
+        bucket = buckets[key] = [Decimal(0), 0, time, payment['time']]
+      bucket[0] += Decimal(str(payment[field]))
+      bucket[1] += 1
+      if time > bucket[2]:
+        bucket[2:] = [time, payment['time']]
+    for ((start, coin), (total, count, _, last)) in sorted(buckets.items()):
+      yield {'coin': coin, 'time': last, field: total, 'period': period, 'periodStart': start.isoformat(), 'records': count}
+  return stage
+
+# Rolled up payments (see interestBuckets) get a key of their own, and say how many payments they stand for
+# in the entry's metadata rather than carrying a raw record.
+def interestKey(kind, payment):
+  if 'period' in payment:
+    return '{0}:{1}:{2}:{3}'.format(kind, payment['coin'], payment['period'], payment['periodStart'])
+  return '{0}:{1}:{2}'.format(kind, payment['coin'], payment['time'])
+
+def interestMeta(payment):
+  return {'records': payment['records']} if 'records' in payment else None
+
+#{'coin': 'SOL', 'time': '2022-03-31T05:00:00+00:00', 'size': 1100.306557, 'rate': 1.142e-05, 'proceeds': 0.01256550088094, 'feeUsd': 1.5198590173526874}
+def lendingTransactions(loans):
+  for loan in loans:
+    quantity = loan['proceeds']
+    currency = loan['coin']
+
+    transaction = Transaction(
+        date=datetime.fromisoformat(loan['time']),
+        description='Lending Interest {0} {1}{2}'.format(quantity, currency, '' if 'records' in loan else ' ;'),
+        raw=loan if 'records' not in loan else None,
+        key=interestKey('lending', loan), meta=interestMeta(loan))
+    transaction.addPosting(account='Assets:Wallet:Interest', currency=currency,
+                           quantity=quantity, description='')
+    transaction.addPosting(account='Income:Interest', currency=currency,
+                           quantity=-quantity, description='')
+    yield transaction
+
+# {'coin': 'USD', 'time': '2022-03-31T15:00:00+00:00', 'size': 575.8747286, 'rate': 2e-06, 'cost': 0.0011517494572, 'feeUsd': 0.0011517494572}
+def borrowTransactions(loans):
+  for loan in loans:
+    quantity = loan['cost']
+    currency = loan['coin']
+
+    transaction = Transaction(
+        date=datetime.fromisoformat(loan['time']),
+        description='Borrowing Interest {0} {1}'.format(quantity, currency),
+        key=interestKey('borrowing', loan), meta=interestMeta(loan))
+    transaction.addPosting(account = 'Assets:Wallet:Interest', currency = currency, quantity = -quantity, description='')
+    transaction.addPosting(account='Income:Interest', currency = currency,
+                           quantity = quantity, description='')
+    yield transaction
+
+# Does what exchange.amount_to_precision and price_to_precision do, but straight to Decimal: the tick size
+# for every market is read once from loadMarkets instead of round-tripping each trade through strings.
+# Amounts are truncated and prices rounded to the nearest tick, as ccxt does.
+class MarketPrecisions:
+  CONTEXT = Context(prec=34)
+
+  def __init__(self, markets):
+    self.amounts = {}
+    self.prices = {}
+    for (symbol, market) in markets.items():
+      self.amounts[symbol] = self.makeRounder(market['precision']['amount'], ROUND_DOWN)
+      self.prices[symbol] = self.makeRounder(market['precision']['price'], ROUND_HALF_UP)
+
+  def makeRounder(self, tickSize, rounding):
+    context = self.CONTEXT
+    if tickSize is None:
+      return lambda value: Decimal(str(value))
+    tick = Decimal(str(tickSize))
+    # Powers of ten are by far the most common tick size, and those only need a quantize.
+    if tick.as_tuple().digits == (1,):
+      return lambda value: Decimal(str(value)).quantize(tick, rounding=rounding, context=context)
+    return lambda value: (Decimal(str(value)) / tick).to_integral_value(rounding=rounding, context=context) * tick
+
+  def amount(self, symbol, amount):
+    return self.amounts[symbol](amount)
+
+  def price(self, symbol, price):
+    return self.prices[symbol](price)
+
+# Turns ccxt's unified trades back into FTX's own fills, with the amount and price rounded to the market's
+# precision, for the fill stage.
+#
+# This is what a full rebuild spends most of its time on, so trades are taken chunkSize at a time. A symbol
+# is split into its currencies and matched with its rounders once, and within a chunk each distinct amount,
+# price and fee (ccxt's numbers are always floats) is converted once: fills on the same market tend to
+# repeat them. The conversions are dropped after every chunk, so they never hold more than a chunk's worth.
+#
+# {'info':, 
+# 'timestamp': 1647280938436, 'datetime': '2022-03-14T18:02:18.436Z', 
+# 'symbol': 'BTC/USD', 'id': '62902857', 'order': '4120253149', '
+# type': None, 'takerOrMaker': 'maker', 'side': 'buy', 'price': 38721.0, 
+# 'amount': 0.1, 'cost': 3872.1, 'fee': {'cost': 0.0001, 
+# 'currency': 'BTC', 'rate': 0.001}, 'fees': [{'currency': 'BTC', 'cost': 0.0001, 'rate': 0.001}]}
+def tradesToFills(precisions, chunkSize = 10000):
+  def stage(trades):
+    # symbol -> (baseCurrency, quoteCurrency, amount rounder, price rounder)
+    symbols = {}
+    trades = iter(trades)
+    while True:
+      chunk = list(islice(trades, chunkSize))
+      if not chunk:
+        return
+      # symbol -> ({amount: size}, {price: price})
+      converted = {}
+      fees = {}
+      for trade in chunk:
+        symbol = trade['symbol']
+        market = symbols.get(symbol)
+        if market is None:
+          (baseCurrency, quoteCurrency) = symbol.split('/')
+          market = symbols[symbol] = (baseCurrency, quoteCurrency, precisions.amounts[symbol], precisions.prices[symbol])
+        (baseCurrency, quoteCurrency, roundAmount, roundPrice) = market
+        (sizes, prices) = converted.get(symbol) or converted.setdefault(symbol, ({}, {}))
+
+        amount = trade['amount']
+        size = sizes.get(amount)
+        if size is None:
+          size = sizes[amount] = roundAmount(amount)
+        price = prices.get(trade['price'])
+        if price is None:
+          price = prices[trade['price']] = roundPrice(trade['price'])
+        fee = trade['fee']
+        cost = fees.get(fee['cost'])
+        if cost is None:
+          cost = fees[fee['cost']] = Decimal(str(fee['cost']))
+
+        yield dict(trade['info'], baseCurrency=baseCurrency, quoteCurrency=quoteCurrency, size=size, price=price,
+                   fee=cost, feeCurrency=fee['currency'])
+  return stage
+
+# {'info': {'id': '38252', 'coin': 'USD', 'size': None, 'status': 'cancelled', 'time': '2022-03-12T15:59:30.922452+00:00', 
+# 'confirmedTime': None, 'uploadedFile': None, 'uploadedFileName': None, 'cancelReason': None, 'fiat': True, 'ach': False, 
+# 'type': 'bank', 'supportTicketId': None}, 'id': '38252', 'txid': None, 'timestamp': 1647100770922, 
+# 'datetime': '2022-03-12T15:59:30.922Z', 'network': None, 'addressFrom': None, 'address': None, 'addressTo': None, 'tagFrom': None, 'tag': None, 'tagTo': None, 'type': 'deposit', 'amount': None, 'currency': 'USD', 'status': 'canceled', 'updated': None, 'fee': {'currency': 'USD', 'cost': None, 'rate': None}}
+def depositsToFtx(deposits):
+  for deposit in deposits:
+    yield deposit['info']
@@ -1,263 +1,212 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
-import ccxt  # noqa: E402
+import json
+import time
+import sqlite3
+import argparse
+import urllib.parse
 from dotenv import dotenv_values
-
-config = dotenv_values(".env")
-
-exchange = ccxt.ftxus({
-    'apiKey': config['API_KEY'],
-    'secret': config['API_SECRET'],
-})
-
-# go back and DO NOT USE the info field
-# exchange.verbose = True  # uncomment for debugging
-
-def fetchTrades(exchange):
-    all_trades = {}
+from ledger import Ledger, LedgerIndex
+from responsecache import ResponseCache
+from pipeline import Source, LedgerSink, runPipeline
+from transforms import MarketPrecisions, tradesToFills, depositsToFtx, fillTransactions, depositTransactions
+from metrics import metrics
+
+# Every GET the exchange makes goes through fetch, so caching there covers loadMarkets as well as trades.
+def cacheResponses(exchange, cache):
+  fetch = exchange.fetch
+
+  def cachedFetch(url, method='GET', headers=None, body=None):
+    if method != 'GET':
+      return fetch(url, method, headers, body)
+    endTime = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('end_time')
+    content = cache.get(url, [exchange.apiKey, body], end_time=endTime[0] if endTime else None)
+    if content is not None:
+      return json.loads(content)
+    response = fetch(url, method, headers, body)
+    cache.put(url, [exchange.apiKey, body], json.dumps(response).encode())
+    return response
+
+  exchange.fetch = cachedFetch
+
+# ccxt takes a long time to import, so it's only imported by runs that talk to the exchange.
+def connect(config, cache, markets):
+  import ccxt
+
+  exchange = ccxt.ftxus({
+      'apiKey': config['API_KEY'],
+      'secret': config['API_SECRET'],
+  })
+  if cache is not None:
+    cacheResponses(exchange, cache)
+  # Otherwise the first call that needs markets would load them from the exchange.
+  if markets is not None:
+    exchange.set_markets(markets)
+  # go back and DO NOT USE the info field
+  # exchange.verbose = True  # uncomment for debugging
+  return exchange
+
+# Every trade we have ever fetched lives here, keyed by trade id, along with the timestamp of the newest
+# trade from the last completed sync. A sync only has to ask the exchange for what came after that.
+#
+# Deposits (there are few of them, and their status changes) are all fetched again by every sync, and the
+# exchange's markets are kept for as long as they're fresh, so that a ledger can be rebuilt from the store
+# alone without going near the exchange.
+class TradeStore:
+  def __init__(self, path):
+    # The pipeline reads trades back from a thread of its own.
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    with self.connection:
+      self.connection.execute('CREATE TABLE IF NOT EXISTS trades (id TEXT PRIMARY KEY, timestamp INTEGER NOT NULL, trade TEXT NOT NULL)')
+      self.connection.execute('CREATE INDEX IF NOT EXISTS trades_by_timestamp ON trades (timestamp)')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 0), timestamp INTEGER NOT NULL)')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS deposits (id TEXT PRIMARY KEY, timestamp INTEGER NOT NULL, deposit TEXT NOT NULL)')
+      self.connection.execute('CREATE TABLE IF NOT EXISTS markets (id INTEGER PRIMARY KEY CHECK (id = 0), fetched REAL NOT NULL, markets TEXT NOT NULL)')
+
+  def getCheckpoint(self):
+    row = self.connection.execute('SELECT timestamp FROM checkpoint WHERE id = 0').fetchone()
+    return row[0] if row else None
+
+  # Only call this once a sync has run to completion; otherwise a gap left by an interrupted sync would never be filled.
+  def setCheckpoint(self, timestamp):
+    with self.connection:
+      self.connection.execute('INSERT OR REPLACE INTO checkpoint (id, timestamp) VALUES (0, ?)', (timestamp,))
+
+  def addTrades(self, trades):
+    with self.connection:
+      self.connection.executemany('INSERT OR IGNORE INTO trades (id, timestamp, trade) VALUES (?, ?, ?)',
+        [(trade['id'], trade['timestamp'], json.dumps(trade)) for trade in trades])
+
+  # since is in milliseconds, like the trades' timestamps.
+  def getTrades(self, since = None):
+    for (trade,) in self.connection.execute('SELECT trade FROM trades WHERE timestamp >= ? ORDER BY timestamp, id', (since or 0,)):
+      yield json.loads(trade)
+
+  def setDeposits(self, deposits):
+    with self.connection:
+      self.connection.executemany('INSERT OR REPLACE INTO deposits (id, timestamp, deposit) VALUES (?, ?, ?)',
+        [(deposit['id'], deposit['timestamp'], json.dumps(deposit)) for deposit in deposits])
+
+  def getDeposits(self, since = None):
+    for (deposit,) in self.connection.execute('SELECT deposit FROM deposits WHERE timestamp >= ? ORDER BY timestamp, id', (since or 0,)):
+      yield json.loads(deposit)
+
+  # None if there are no markets, or (given a maxAge) if they were fetched more than maxAge seconds ago.
+  def getMarkets(self, maxAge = None):
+    row = self.connection.execute('SELECT fetched, markets FROM markets WHERE id = 0').fetchone()
+    if row is None or (maxAge is not None and time.time() - row[0] > maxAge):
+      return None
+    return json.loads(row[1])
+
+  def setMarkets(self, markets):
+    with self.connection:
+      self.connection.execute('INSERT OR REPLACE INTO markets (id, fetched, markets) VALUES (0, ?, ?)', (time.time(), json.dumps(markets, default=str)))
+
+
+# Walk backwards from now until we reach the checkpoint of the last completed sync (or the beginning of time
+# on the first run), merging whatever we find into the store.
+def fetchTrades(exchange, store, cache):
     symbol = None
     since = None
     limit = 200
-    end_time = exchange.milliseconds()
+    # The cache hands out the same "now" to re-runs so that they make the same requests.
+    end_time = cache.now() * 1000 if cache is not None else exchange.milliseconds()
+    checkpoint = store.getCheckpoint()
+    newest = checkpoint
+    seen = set()
 
     while True:
       params = {'end_time': int(end_time / 1000),}
+      if checkpoint is not None:
+          params['start_time'] = int(checkpoint / 1000)
       trades = exchange.fetch_my_trades(symbol, since, limit, params)
       if len(trades):
           first_trade = trades[0]
           last_trade = trades[len(trades) - 1]
           end_time = first_trade['timestamp'] + 1000
           #print('Fetched', len(trades), 'trades from', first_trade['datetime'], 'till', last_trade['datetime'])
-          fetched_new_trades = False
-          for trade in trades:
-              trade_id = trade['id']
-              if trade_id not in all_trades:
-                  fetched_new_trades = True
-                  all_trades[trade_id] = trade
-          if not fetched_new_trades:
+          new_trades = [trade for trade in trades if trade['id'] not in seen]
+          if not new_trades:
               break
+          seen.update(trade['id'] for trade in new_trades)
+          store.addTrades(new_trades)
+          if newest is None or last_trade['timestamp'] > newest:
+              newest = last_trade['timestamp']
       else:
           break
-        
-    all_trades = list(all_trades.values())
-    return all_trades
 
-all_trades = fetchTrades(exchange)
-
-
-# Make all FIAT currency look alike register as one as they are treated all the same, unfortunately, by FTX
-def normalizeCurrency(currency):
-  STABLE_USD_COINS = {'USD', 'USDC', 'TUSD', 'USDP', 'BUSD', 'HUSD'}
-  if currency in STABLE_USD_COINS:
-    return 'USD'
+    if newest is not None:
+        store.setCheckpoint(newest)
+
+def main():
+  parser = argparse.ArgumentParser(description='Convert your FTX US trades into a beancount ledger.')
+  parser.add_argument('--output', help='write the ledger here instead of to stdout')
+  parser.add_argument('--no-raw', dest='raw', action='store_false', help="leave the exchange's raw records out of entry descriptions")
+  parser.add_argument('--balance-assertions', action='store_true', help='finish the ledger with a balance assertion for every account')
+  parser.add_argument('--render-workers', type=int, help='render the ledger\'s entries with this many processes, keeping up to a million of them in memory for it')
+  parser.add_argument('--cache-dir', help='keep raw API responses here and reuse them on later runs')
+  parser.add_argument('--cache-ttl', type=float, default=60 * 60, help='seconds before a cached response is fetched again')
+  parser.add_argument('--offline', action='store_true', help='replay responses from --cache-dir without touching the exchange')
+  parser.add_argument('--rebuild', action='store_true', help='write the ledger from the trade store alone, without syncing or loading ccxt')
+  parser.add_argument('--markets-ttl', type=float, default=24 * 60 * 60, help='seconds before the market list kept in the trade store is fetched again')
+  parser.add_argument('--append', action='store_true', help='only add what isn\'t in --output yet, going by the keys kept in <output>.keys')
+  parser.add_argument('--shard-dir', help='write entries to one file per period here, and includes for them to --output')
+  parser.add_argument('--shard-by', choices=['year', 'month'], default='year', help='how much of the ledger goes in each shard')
+  parser.add_argument('--metrics-file', help='also write the run\'s metrics here in the Prometheus text format')
+  parser.add_argument('--profile-dir', help='profile every stage of the run with cProfile into <stage>.prof files here')
+  parser.add_argument('--trace-memory', action='store_true', help='record the peak memory of every stage with tracemalloc')
+  args = parser.parse_args()
+  if args.offline and not args.cache_dir:
+    parser.error('--offline needs --cache-dir')
+  if args.append and (not args.output or args.shard_dir or args.balance_assertions):
+    parser.error('--append needs --output, and only has the new entries to go on, so no --shard-dir or --balance-assertions')
+  if args.rebuild and args.offline:
+    parser.error('--rebuild and --offline are different ways of running without the exchange; pick one')
+  metrics.profile_dir = args.profile_dir
+  metrics.trace_memory = args.trace_memory
+
+  config = dotenv_values(".env")
+  store = TradeStore(config.get('TRADE_STORE') or 'trades.sqlite3')
+  markets = store.getMarkets(maxAge=None if args.rebuild else args.markets_ttl)
+  if args.rebuild:
+    if markets is None:
+      parser.error('--rebuild needs a trade store that has been synced at least once')
   else:
-    return currency
-
-class Ledger:
-  def __init__(self):
-    self.entries = []
-
-  def addEntry(self, date, description):
-    entry = LedgerEntry(date, description)
-    self.entries.append(entry)
-    return entry
-
-  def getAccountsAndCurrencies(self):
-    # horribly inefficient
-    accounts = set()
-    currencies = set()
-    for entry in self.entries:
-      for item in entry.items:
-        currencies.add(item.currency)
-        accounts.add(item.account)
-    return (accounts, currencies)
-
-  def getEntries(self):
-   return sorted(self.entries, key=lambda entry: entry.date, reverse=False)
-
-
-class LedgerEntry:
-  class Item:
-    def __init__(self, account, currency, quantity, inputCommodity, inputQuantity, description):
-      self.currency = normalizeCurrency(currency)
-      self.account = account #"{account}:{currency}".format(account = account, currency = self.currency)
-      self.quantity = quantity
-      self.description = description
-      self.inputCommodity = inputCommodity
-      self.inputQuantity = inputQuantity
-
-    def generateCostBasisText(self):
-      return "" if (self.inputCommodity == None or self.inputQuantity == None) else '{{{quantity:.13f} {commodity}}}'.format(quantity = self.inputQuantity, commodity = normalizeCurrency(self.inputCommodity))
-
-    def generateDescriptionComment(self):
-      return ';; {0}'.format(self.description) if self.description else ''
-
-
-    # NB: The precision here is hack; it should really be based on the known precision; i had to force it here to get rid of scientific notation because beancounter doesn't understand it.
-    def __repr__(self):
-      print("qq--", self.quantity)
-      if (self.currency == None or self.quantity == None):
-        return "{account}\t{comment}".format(account=self.account, comment = self.generateDescriptionComment())
-      else:
-        return "{account}\t{quantity} {currency} {costBasis} {comment}".format(account = self.account, quantity = self.quantity, currency = self.currency, costBasis = self.generateCostBasisText(), comment = self.generateDescriptionComment())
-
-
-  def __init__(self, date, description):
-    self.date = date
-    self.description = description
-    self.items = []
-
-  def addItem(self, account, currency = None, quantity = None, inputCommodity = None, inputQuantity = None, description = ''):
-    print(quantity, description)
-    self.items.append(self.Item(account=account, currency=currency, quantity=quantity,
-                      inputCommodity=inputCommodity, inputQuantity=inputQuantity, description=description))
-
-  def print(self):
-    print('{0} * "{1}"'.format(self.date.strftime("%Y/%m/%d"), self.description))
-    for item in self.items:
-      print("  {}".format(item))
-    print()
-
-
-import sys
-
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
-
-ledger = Ledger()
-
-from decimal import *
-import dateutil.parser
-
-
-class Symbol:
-  def __init__(self, symbol):
-    self.symbol = symbol
-    (self.baseCurrency, self.quoteCurrency) = symbol.split('/')
-  
-  def __repr__(self):
-    return self.symbol
-
-# The way that FTX does charges is as follows
-# Say you by 1 BTC for 1000 USD and your Maker fee is 1%
-# You will be 0.01 BTC (BTC because is Maker fee).
-# So you will debit 1000 USD to bay for 1 BTC
-# Then you will debit 0.1 BTC for yoru feel
-# You will then have 0.99 BTC @ 1000 USD and -1000 USD in your accounts
-
-
-#def amount_to_precision (symbol, amount):
-#def price_to_precision (symbol, price):
-#def cost_to_precision (symbol, cost):
-#def currency_to_precision (code, amount):
-
-exchange.loadMarkets()
-
-
-
-# {'info':, 
-# 'timestamp': 1647280938436, 'datetime': '2022-03-14T18:02:18.436Z', 
-# 'symbol': 'BTC/USD', 'id': '62902857', 'order': '4120253149', '
-# type': None, 'takerOrMaker': 'maker', 'side': 'buy', 'price': 38721.0, 
-# 'amount': 0.1, 'cost': 3872.1, 'fee': {'cost': 0.0001, 
-# 'currency': 'BTC', 'rate': 0.001}, 'fees': [{'currency': 'BTC', 'cost': 0.0001, 'rate': 0.001}]}
-for trade in all_trades:
-  fill = trade['info']
-  # this type is wrongl;
-  feeCurrency = trade['fee']['currency']
-  symbol = Symbol(trade['symbol'])
-  size = Decimal(exchange.amount_to_precision(trade['symbol'], trade['amount']))
-  price = Decimal(exchange.price_to_precision(trade['symbol'], trade['price']))
-  fee = Decimal(trade['fee']['cost'])
-  baseCurrency = symbol.baseCurrency
-  quoteCurrency = symbol.quoteCurrency
-  dateTime = dateutil.parser.parse(trade['datetime']);
-
-  entry = ledger.addEntry(dateTime, "fillid-{0}: {1} {2} {3} @ {4} {5} ea. {6}".format(
-      fill['id'], fill['side'], size, baseCurrency, price, quoteCurrency, fill))
-  entry.addItem(account="Assets:Wallet",
-                currency=baseCurrency, quantity=size, inputCommodity=quoteCurrency, inputQuantity=price, description="Purchase")
-   
-  #  {'id': 63820377, 'market': 'SOL/USD', 'future': None, 'baseCurrency': 'SOL', 'quoteCurrency': 'USD', 
-  # 'type': 'order', 'side': 'buy', 'price': 89.7775, 'size': 15.0, 'orderId': 4216671021, 
-  # 'time': '2022-03-21T13:54:26.393415+00:00', 'tradeId': 27130489, 'feeRate': 0.0008, 'fee': 0.012, 
-  # 'feeCurrency': 'SOL', 'liquidity': 'maker'}
-  doItRight = False
-  if not doItRight and quoteCurrency != feeCurrency:
-    print("rr--", fee)
-    entry.addItem(account="Expenses:Fees", currency=feeCurrency, quantity=fee, inputCommodity=quoteCurrency, inputQuantity=price, description='Fee rate of {feeRate} of {fee} as {makerOrTaker}'.format(feeRate = fill['feeRate'], fee = fee, makerOrTaker=fill['liquidity']))
-  else:
-    entry.addItem(account="Expenses:Fees", currency=feeCurrency, quantity=fee, description='Fee rate of {feeRate} of {fee} as {makerOrTaker}'.format(feeRate= fill['feeRate'], fee = fee, makerOrTaker = fill['liquidity']))
-  entry.addItem(account="Assets:Wallet", currency=feeCurrency)
-
-exit(0)
-# {'info': {'id': '38252', 'coin': 'USD', 'size': None, 'status': 'cancelled', 'time': '2022-03-12T15:59:30.922452+00:00', 
-# 'confirmedTime': None, 'uploadedFile': None, 'uploadedFileName': None, 'cancelReason': None, 'fiat': True, 'ach': False, 
-# 'type': 'bank', 'supportTicketId': None}, 'id': '38252', 'txid': None, 'timestamp': 1647100770922, 
-# 'datetime': '2022-03-12T15:59:30.922Z', 'network': None, 'addressFrom': None, 'address': None, 'addressTo': None, 'tagFrom': None, 'tag': None, 'tagTo': None, 'type': 'deposit', 'amount': None, 'currency': 'USD', 'status': 'canceled', 'updated': None, 'fee': {'currency': 'USD', 'cost': None, 'rate': None}}
-for depositEntry in exchange.fetchDeposits():
-  deposit = depositEntry['info']
-  if deposit['size'] != None:
-    currency = deposit['coin']
-    quantity = Decimal(deposit['size'])
-    entry = ledger.addEntry(
-      date = dateutil.parser.parse(depositEntry['datetime']),
-      description = 'Deposit {0} {1}'.format(quantity, currency))
-    entry.addItem(
-      account = 'Assets:Wallet',
-      currency = currency,
-      quantity = quantity,
-      description = '')
-    entry.addItem(
-      account = 'Income:Investments',
-      currency=currency,
-      quantity = -quantity,
-      description='')
-
-if False:
-  #{'coin': 'SOL', 'time': '2022-03-31T05:00:00+00:00', 'size': 1100.306557, 'rate': 1.142e-05, 'proceeds': 0.01256550088094, 'feeUsd': 1.5198590173526874}
-  for loan in ftxClient.get_lending_history():
-    quantity = loan['proceeds']
-    currency = loan['coin']
-
-    entry = ledger.addEntry(
-        date=datetime.fromisoformat(loan['time']),
-        description='Lending Interest {0} {1} ; {2}'.format(quantity, currency, loan))
-    entry.addItem(account='Assets:Wallet:Interest', currency=currency,
-                  quantity=quantity, description='')
-    entry.addItem(account='Income:Interest', currency=currency,
-                  quantity=-quantity, description='')
-
-  # add borrows
-  # {'coin': 'USD', 'time': '2022-03-31T15:00:00+00:00', 'size': 575.8747286, 'rate': 2e-06, 'cost': 0.0011517494572, 'feeUsd': 0.0011517494572}
-  for loan in ftxClient.get_borrow_history():
-    quantity = loan['cost']
-    currency = loan['coin']
-
-    entry = ledger.addEntry(
-        date=datetime.fromisoformat(loan['time']),
-        description='Borrowing Interest {0} {1}'.format(quantity, currency))
-    entry.addItem(account = 'Assets:Wallet:Interest', currency = currency, quantity = -quantity, description='')
-    entry.addItem(account='Income:Interest', currency = currency,
-                  quantity = quantity, description='')
-
-print('option "operating_currency" "USD"')
-
-(accounts, currencies) = ledger.getAccountsAndCurrencies()
-for account in accounts:
-  print("2003-01-05 open {0}".format(account))
-
-for currency in currencies:
-  print(
-  """
-2000-01-01 commodity {currency}
-  price: "USD:coinbase/{currency}-USD"
-  """.format(currency = currency))
-
-for entry in ledger.getEntries():
-  entry.print()
-
-print('plugin "beancount.plugins.unrealized" "Unrealized"')
+    cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl, offline=args.offline) if args.cache_dir else None
+    with metrics.stage('connect'):
+      exchange = connect(config, cache, markets)
+      if markets is None:
+        markets = exchange.loadMarkets()
+        store.setMarkets(markets)
+    with metrics.stage('sync'):
+      fetchTrades(exchange, store, cache)
+      store.setDeposits(exchange.fetchDeposits())
+
+  index = LedgerIndex(args.output + '.keys') if args.append else None
+  # Trades can be stored a little after they happen, so look back a day past the newest one written.
+  since = (index.newest - 24 * 60 * 60) * 1000 if index is not None and index.newest is not None else None
+  ledger = Ledger(keepRaw=args.raw, renderWorkers=args.render_workers)
+  with metrics.stage('export'):
+    runPipeline([
+      Source('trades', lambda: store.getTrades(since), tradesToFills(MarketPrecisions(markets)), fillTransactions(feeAtCost=True)),
+      Source('deposits', lambda: store.getDeposits(since), depositsToFtx, depositTransactions),
+    ], LedgerSink(ledger, index))
+
+  with metrics.stage('write'):
+    if args.append:
+      ledger.append(args.output, index)
+    elif args.shard_dir:
+      ledger.writeShards(args.output or os.path.join(args.shard_dir, 'ledger.beancount'), args.shard_dir,
+                         period=args.shard_by, balanceAssertions=args.balance_assertions)
+    else:
+      with (open(args.output, 'w', buffering=1 << 20) if args.output else sys.stdout) as out:
+        ledger.write(out, balanceAssertions=args.balance_assertions)
+
+  sys.stderr.write(metrics.summary())
+  if args.metrics_file:
+    metrics.write_prometheus(args.metrics_file)
 # Next step get the costs in this
 
-
+if __name__ == '__main__':
+  main()
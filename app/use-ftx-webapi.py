@@ -1,23 +1,99 @@
 from locale import currency
 from posixpath import curdir
 import time
+import random
+import asyncio
+import threading
 import urllib.parse
-from typing import Optional, Dict, Any, List
-
-from requests import Request, Session, Response
+import email.utils
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Iterator, Callable, Hashable, Tuple
+
+from requests import Request, Session, Response, PreparedRequest
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestConnectionError, ChunkedEncodingError, Timeout
 import hmac
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from decimal import *
-import simplejson
+from responsecache import ResponseCache
+from decoding import JsonDecoder
+from metrics import Metrics, metrics as default_metrics
+
+class _RecentIds:
+    # Remembers only the last `size` ids it has seen. Pages from _paginate only overlap at window
+    # boundaries, so that's all that's needed to drop duplicates.
+    def __init__(self, size: int) -> None:
+        self._order = deque()
+        self._ids = set()
+        self._size = size
+
+    def add(self, id: Hashable) -> bool:
+        if id in self._ids:
+            return False
+        self._ids.add(id)
+        self._order.append(id)
+        if len(self._order) > self._size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+class RateLimiter:
+    # A token bucket: holds up to `capacity` tokens and refills at `rate` tokens a second. Share one between
+    # clients (and threads) that count against the same exchange limit.
+    def __init__(self, rate: float = 30, capacity: float = 30) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        # The bucket never holds more than its capacity, so waiting for more would never end.
+        if tokens > self._capacity:
+            raise ValueError(f'a request costing {tokens} tokens can never fit in a bucket of {self._capacity}')
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                delay = (tokens - self._tokens) / self._rate
+            time.sleep(delay)
+
 
 class FtxClient:
     _ENDPOINT = 'https://ftx.us/api/'
-
-    def __init__(self, api_key=None, api_secret=None, subaccount_name=None) -> None:
-        self._session = Session()
+    # Requests to paths starting with these cost more than one token from the rate limiter.
+    _ENDPOINT_WEIGHTS = {}
+    _RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # The most records the history endpoints return for a single request; a page this full may have been
+    # truncated, so the paginator keeps walking back from its oldest record.
+    _HISTORY_PAGE_LIMIT = 5000
+
+    def __init__(self, api_key=None, api_secret=None, subaccount_name=None, endpoint: str = None,
+                 rate_limiter: RateLimiter = None, endpoint_weights: Dict[str, float] = None,
+                 max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 30,
+                 timeout: Tuple[float, float] = (10, 60), cache: ResponseCache = None, decoder: Any = None,
+                 metrics: Metrics = None) -> None:
+        # A requests.Session isn't safe to share between threads, so each thread gets its own.
+        self._sessions = threading.local()
         self._api_key = api_key
         self._api_secret = api_secret
         self._subaccount_name = subaccount_name
+        self._endpoint = endpoint or self._ENDPOINT
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._endpoint_weights = {**self._ENDPOINT_WEIGHTS, **(endpoint_weights or {})}
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        # (connect, read) seconds; without them a stalled connection would hang the export rather than be retried.
+        self._timeout = timeout
+        self._cache = cache
+        self._decoder = decoder or JsonDecoder()
+        self._metrics = metrics or default_metrics
 
     def _get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
         return self._request('GET', path, params=params)
@@ -29,18 +105,126 @@ class FtxClient:
         return self._request('DELETE', path, json=params)
 
     def _request(self, method: str, path: str, **kwargs) -> Any:
-        request = Request(method, self._ENDPOINT + path, **kwargs)
-        self._sign_request(request)
-        response = self._session.send(request.prepare())
-        return self._process_response(response)
-
-    def _sign_request(self, request: Request) -> None:
+        if self._cache is None or method != 'GET':
+            return self._process_response(self._send(method, path, **kwargs), path)
+        # Responses differ between subaccounts, so they're part of what a response is cached under.
+        cache_params = [self._api_key, self._subaccount_name, kwargs.get('params')]
+        content = self._cache.get(path, cache_params, end_time=(kwargs.get('params') or {}).get('end_time'))
+        if content is not None:
+            self._metrics.count('ftx_cache_hits_total', endpoint=path)
+            with self._metrics.timer('ftx_decode_seconds', endpoint=path):
+                return self._result(self._decoder.loads(content))
+        response = self._send(method, path, **kwargs)
+        result = self._process_response(response, path)
+        self._cache.put(path, cache_params, response.content)
+        return result
+
+    def _now(self) -> float:
+        return self._cache.now() if self._cache is not None else time.time()
+
+    # The records of a GET's result, parsed off the wire as they arrive. The page is read to its end before
+    # any of it is handed out, so that a slow reader (a pipeline source waiting on a full buffer, say) can't
+    # hold the connection open halfway through a body, and a page whose body breaks off is fetched again.
+    # Cached responses have to be read whole to be stored, so they aren't streamed.
+    def _get_records(self, path: str, params: Optional[Dict[str, Any]] = None) -> Iterator[dict]:
+        if self._cache is not None:
+            return iter(self._get(path, params))
+        attempt = 0
+        while True:
+            response = self._send('GET', path, stream=True, params=params)
+            try:
+                if not response.ok:
+                    return iter(self._process_response(response, path))
+                return iter(list(self._decoder.iter_results(self._count_bytes(path, response.iter_content(chunk_size=1 << 16)))))
+            except (RequestConnectionError, ChunkedEncodingError, Timeout) as error:
+                self._metrics.count('ftx_errors_total', endpoint=path, error=type(error).__name__)
+                if attempt >= self._max_retries:
+                    raise
+            finally:
+                response.close()
+            self._wait_to_retry(path, self._backoff_delay(attempt))
+            attempt += 1
+
+    def _count_bytes(self, path: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            self._metrics.count('ftx_response_bytes_total', len(chunk), endpoint=path)
+            yield chunk
+
+    def _send(self, method: str, path: str, stream: bool = False, **kwargs) -> Response:
+        weight = self._endpoint_weight(path)
+        attempt = 0
+        while True:
+            self._rate_limiter.acquire(weight)
+            # Signatures carry a timestamp, so every attempt is signed afresh.
+            request = Request(method, self._endpoint + path, **kwargs).prepare()
+            self._sign_request(request)
+            started = time.perf_counter()
+            try:
+                response = self._get_session().send(request, stream=stream, timeout=self._timeout)
+            except (RequestConnectionError, Timeout) as error:
+                self._metrics.observe('ftx_request_seconds', time.perf_counter() - started, endpoint=path)
+                self._metrics.count('ftx_errors_total', endpoint=path, error=type(error).__name__)
+                if method != 'GET' or attempt >= self._max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+            else:
+                # Streamed responses are timed to their headers; the body is read as it's parsed.
+                self._metrics.observe('ftx_request_seconds', time.perf_counter() - started, endpoint=path)
+                self._metrics.count('ftx_responses_total', endpoint=path, status=response.status_code)
+                # Only GETs are safe to resend after a server error; anything else may already have happened.
+                retryable = response.status_code == 429 or (method == 'GET' and response.status_code in self._RETRY_STATUSES)
+                if not retryable or attempt >= self._max_retries:
+                    return response
+                delay = self._retry_after(response)
+                response.close()
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+            self._wait_to_retry(path, delay)
+            attempt += 1
+
+    def _wait_to_retry(self, path: str, delay: float) -> None:
+        self._metrics.count('ftx_retries_total', endpoint=path)
+        self._metrics.observe('ftx_retry_wait_seconds', delay, endpoint=path)
+        time.sleep(delay)
+
+    def _endpoint_weight(self, path: str) -> float:
+        for prefix, weight in self._endpoint_weights.items():
+            if path.startswith(prefix):
+                return weight
+        return 1
+
+    def _backoff_delay(self, attempt: int) -> float:
+        # Exponential backoff with full jitter so that retrying threads don't stampede together.
+        return random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+
+    def _retry_after(self, response: Response) -> Optional[float]:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _get_session(self) -> Session:
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            session = self._sessions.session = Session()
+            # Every thread talks to the one host over its own kept-alive connection; retries are ours.
+            session.mount(self._endpoint, HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+        return session
+
+    def _sign_request(self, request: PreparedRequest) -> None:
         ts = int(time.time() * 1000)
-        prepared = request.prepare()
-        signature_payload = f'{ts}{prepared.method}{prepared.path_url}'.encode(
+        signature_payload = f'{ts}{request.method}{request.path_url}'.encode(
         )
-        if prepared.body:
-            signature_payload += prepared.body
+        if request.body:
+            body = request.body
+            signature_payload += body.encode() if isinstance(body, str) else body
         signature = hmac.new(self._api_secret.encode(),
                              signature_payload, 'sha256').hexdigest()
         request.headers['FTXUS-KEY'] = self._api_key
@@ -50,16 +234,64 @@ class FtxClient:
             request.headers['FTXUS-SUBACCOUNT'] = urllib.parse.quote(
                 self._subaccount_name)
 
-    def _process_response(self, response: Response) -> Any:
+    def _process_response(self, response: Response, path: str) -> Any:
+        content = response.content
+        self._metrics.count('ftx_response_bytes_total', len(content), endpoint=path)
         try:
-            data = simplejson.loads(response.text, use_decimal=True)
+            with self._metrics.timer('ftx_decode_seconds', endpoint=path):
+                data = self._decoder.loads(content)
         except ValueError:
             response.raise_for_status()
             raise
         else:
-            if not data['success']:
-                raise Exception(data['error'])
-            return data['result']
+            return self._result(data)
+
+    def _result(self, data: Any) -> Any:
+        if not data['success']:
+            raise Exception(data['error'])
+        return data['result']
+
+    def _paginate(
+        self, path: str, params: Optional[Dict[str, Any]] = None, start_time: float = None,
+        end_time: float = None, page_limit: int = None, window: float = 24 * 60 * 60,
+        key: Callable[[dict], Hashable] = lambda record: record['id'], dedup_window: int = 10000
+    ) -> Iterator[dict]:
+        """
+        Walk a history endpoint backwards from end_time to start_time, yielding records as pages arrive.
+        The start_time/end_time window of each request is resized from the density of the previous page so
+        that pages come back reasonably full without being truncated.
+        """
+        page_limit = page_limit or self._HISTORY_PAGE_LIMIT
+        start_time = start_time or 0
+        end_time = end_time if end_time is not None else self._now()
+        recent_ids = _RecentIds(dedup_window)
+        while end_time > start_time:
+            window_start = max(start_time, end_time - window)
+            # Times share a format and offset, so the smallest string is the oldest and only it needs parsing.
+            count = 0
+            oldest = None
+            for record in self._get_records(path, {**(params or {}), 'start_time': window_start, 'end_time': end_time}):
+                count += 1
+                if oldest is None or record['time'] < oldest:
+                    oldest = record['time']
+                if recent_ids.add(key(record)):
+                    yield record
+
+            if count >= page_limit:
+                # Possibly truncated: carry on from the oldest record we got.
+                oldest = datetime.fromisoformat(oldest).timestamp()
+                covered = end_time - oldest
+                end_time = oldest if oldest < end_time else end_time - 1e-6
+            else:
+                covered = end_time - window_start
+                end_time = window_start
+
+            # Aim the next window at half a page's worth of records, growing or shrinking by at most 8x.
+            if count:
+                window = min(max(covered * page_limit / (2 * count), window / 8), window * 8)
+            else:
+                window *= 8
+            window = max(window, 1)
 
     def get_all_futures(self) -> List[dict]:
         return self._get('futures')
@@ -186,14 +418,80 @@ class FtxClient:
 
     def get_fills(self, market: str = None, start_time: float = None,
                   end_time: float = None, min_id: int = None, order_id: int = None
-                  ) -> List[dict]:
-        return self._get('fills', {
+                  ) -> Iterator[dict]:
+        return self._paginate('fills', {
             'market': market,
-            'start_time': start_time,
-            'end_time': end_time,
             'minId': min_id,
             'orderId': order_id
-        })
+        }, start_time=start_time, end_time=end_time)
+
+    def _first_fill_time(self, start_time: float, end_time: float, window: float) -> Optional[float]:
+        """
+        Roughly when the account's first fill between start_time and end_time was, to within a window, found
+        by bisecting with single requests. A page that isn't full holds the oldest fill of its range, so most
+        histories are pinned down exactly well before that. None if there are no fills at all.
+        """
+        low, high = start_time, end_time
+        found = False
+        while high - low > window:
+            middle = (low + high) / 2
+            times = [fill['time'] for fill in self._get_records('fills', {'start_time': low, 'end_time': middle})]
+            if not times:
+                low = middle
+                continue
+            found = True
+            oldest = datetime.fromisoformat(min(times)).timestamp()
+            if len(times) < self._HISTORY_PAGE_LIMIT:
+                return oldest
+            high = oldest
+        if found:
+            return low
+        times = [fill['time'] for fill in self._get_records('fills', {'start_time': low, 'end_time': end_time})]
+        return low if times else None
+
+    def get_all_fills(self, start_time: float = 0, end_time: float = None,
+                      window: float = 90 * 24 * 60 * 60, max_workers: int = 8) -> Iterator[dict]:
+        """
+        Fetch every fill between start_time and end_time, in time order. The history is split into windows
+        from the account's first fill on, which are paginated concurrently across all markets at once, so
+        markets that have since been delisted are included. Only a few windows are fetched ahead of whoever
+        is reading, so memory holds about max_workers windows' worth of fills rather than the whole history.
+        """
+        if end_time is None:
+            end_time = self._now()
+        first = self._first_fill_time(start_time or 0, end_time, window)
+        if first is None:
+            return
+
+        partitions = []
+        window_start = max(start_time or 0, first)
+        while window_start < end_time:
+            window_end = min(window_start + window, end_time)
+            partitions.append((window_start, window_end))
+            window_start = window_end
+
+        def fetch(partition: Tuple[float, float]) -> List[dict]:
+            fills = list(self.get_fills(start_time=partition[0], end_time=partition[1]))
+            return sorted(fills, key=lambda fill: (fill['time'], fill['id']))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            partitions = iter(partitions)
+            # A fill right on the boundary between windows can come back in both.
+            previous_ids = set()
+            while True:
+                while len(pending) < max_workers:
+                    partition = next(partitions, None)
+                    if partition is None:
+                        break
+                    pending.append(executor.submit(fetch, partition))
+                if not pending:
+                    break
+                fills = pending.popleft().result()
+                for fill in fills:
+                    if fill['id'] not in previous_ids:
+                        yield fill
+                previous_ids = {fill['id'] for fill in fills}
 
     def get_balances(self) -> List[dict]:
         return self._get('wallet/balances')
@@ -222,27 +520,9 @@ class FtxClient:
     def get_position(self, name: str, show_avg_price: bool = False) -> dict:
         return next(filter(lambda x: x['future'] == name, self.get_positions(show_avg_price)), None)
 
-    def get_all_trades(self, market: str, start_time: float = None, end_time: float = None) -> List:
-        ids = set()
-        limit = 100
-        results = []
-        while True:
-            response = self._get(f'markets/{market}/trades', {
-                'end_time': end_time,
-                'start_time': start_time,
-            })
-            deduped_trades = [r for r in response if r['id'] not in ids]
-            results.extend(deduped_trades)
-            ids |= {r['id'] for r in deduped_trades}
-            print(f'Adding {len(response)} trades with end time {end_time}')
-            if len(response) == 0:
-                break
-
-            end_time = min(datetime.fromisoformat(t['time'])
-                           for t in response).timestamp()
-            if len(response) < limit:
-                break
-        return results
+    def get_all_trades(self, market: str, start_time: float = None, end_time: float = None) -> Iterator[dict]:
+        return self._paginate(f'markets/{market}/trades', start_time=start_time, end_time=end_time,
+                              page_limit=100, window=60 * 60)
 
     def get_historical_prices(
         self, market: str, resolution: int = 300, start_time: float = None,
@@ -254,20 +534,39 @@ class FtxClient:
             'end_time': end_time
         })
 
+    # Candles are public and the endpoint returns at most this many per request.
+    _CANDLE_PAGE_LIMIT = 1500
+
+    def get_all_historical_prices(self, market: str, resolution: int = 300, start_time: float = 0,
+                                  end_time: float = None) -> Iterator[dict]:
+        """Every candle of market between start_time and end_time, oldest first."""
+        end_time = end_time if end_time is not None else self._now()
+        newest = None
+        window_start = start_time
+        while window_start < end_time:
+            window_end = min(window_start + resolution * self._CANDLE_PAGE_LIMIT, end_time)
+            # Windows share their ends, so a candle on the boundary comes back twice.
+            for candle in sorted(self.get_historical_prices(market, resolution, window_start, window_end),
+                                 key=lambda candle: candle['time']):
+                if newest is None or candle['time'] > newest:
+                    newest = candle['time']
+                    yield candle
+            window_start = window_end
+
     def get_last_historical_prices(self, market: str, resolution: int = 300) -> List[dict]:
         return self._get(f'markets/{market}/candles/last', {'resolution': resolution})
 
     def get_borrow_rates(self) -> List[dict]:
         return self._get('spot_margin/borrow_rates')
 
-    def get_borrow_history(self, start_time: float = None, end_time: float = None) -> List[dict]:
-        return self._get('spot_margin/borrow_history', {'start_time': start_time, 'end_time': end_time})
+    # Interest payments don't have ids; there is at most one per coin per hour.
+    def get_borrow_history(self, start_time: float = None, end_time: float = None) -> Iterator[dict]:
+        return self._paginate('spot_margin/borrow_history', start_time=start_time, end_time=end_time,
+                              key=lambda payment: (payment['coin'], payment['time']))
 
-    def get_lending_history(self, start_time: float = None, end_time: float = None) -> List[dict]:
-        return self._get('spot_margin/lending_history', {
-            'start_time': start_time,
-            'end_time': end_time
-        })
+    def get_lending_history(self, start_time: float = None, end_time: float = None) -> Iterator[dict]:
+        return self._paginate('spot_margin/lending_history', start_time=start_time, end_time=end_time,
+                              key=lambda payment: (payment['coin'], payment['time']))
 
     def get_expired_futures(self) -> List[dict]:
         return self._get('expired_futures')
@@ -330,8 +629,8 @@ class FtxClient:
     def get_deposit_address(self, ticker: str) -> dict:
         return self._get(f'wallet/deposit_address/{ticker}')
 
-    def get_deposit_history(self) -> List[dict]:
-        return self._get('wallet/deposits')
+    def get_deposit_history(self, start_time: float = None, end_time: float = None) -> Iterator[dict]:
+        return self._paginate('wallet/deposits', start_time=start_time, end_time=end_time)
 
     def get_withdrawal_fee(self, coin: str, size: int, address: str, method: str = None, tag: str = None) -> Dict:
         return self._get('wallet/withdrawal_fee', {
@@ -342,8 +641,8 @@ class FtxClient:
             'tag': tag
         })
 
-    def get_withdrawals(self, start_time: float = None, end_time: float = None) -> List[dict]:
-        return self._get('wallet/withdrawals', {'start_time': start_time, 'end_time': end_time})
+    def get_withdrawals(self, start_time: float = None, end_time: float = None) -> Iterator[dict]:
+        return self._paginate('wallet/withdrawals', start_time=start_time, end_time=end_time)
 
     def get_saved_addresses(self, coin: str = None) -> dict:
         return self._get('wallet/saved_addresses', {'coin': coin})
@@ -360,183 +659,259 @@ class FtxClient:
         return self._get('stats/latency_stats', {'days': days, 'subaccount_nickname': subaccount_nickname})
 
 
-from dotenv import dotenv_values
-
-config = dotenv_values(".env")
-
-ftxClient  = FtxClient(api_key = config['API_KEY'], 
-          api_secret = config['API_SECRET'])
-
-# Make all FIAT currency look alike register as one as they are treated all the same, unfortunately, by FTX
-def normalizeCurrency(currency):
-  STABLE_USD_COINS = {'USD', 'USDC', 'TUSD', 'USDP', 'BUSD', 'HUSD'}
-  if currency in STABLE_USD_COINS:
-    return 'USD'
-  else:
-    return currency
-
-class Ledger:
-  def __init__(self):
-    self.entries = []
-
-  def addEntry(self, date, description):
-    entry = LedgerEntry(date, description)
-    self.entries.append(entry)
-    return entry
-
-  def getAccountsAndCurrencies(self):
-    # horribly inefficient
-    accounts = set()
-    currencies = set()
-    for entry in self.entries:
-      for item in entry.items:
-        currencies.add(item.currency)
-        accounts.add(item.account)
-    return (accounts, currencies)
-
-  def getEntries(self):
-   return sorted(self.entries, key=lambda entry: entry.date, reverse=False)
+class AsyncFtxClient:
+    """
+    FtxClient's methods as coroutines, e.g. `await client.get_fills('BTC/USD')`, for issuing many requests
+    at once from asyncio code. Up to max_connections calls are in flight at a time, each on a worker thread
+    with its own kept-alive connection, and every call still goes through the client's rate limiter,
+    retries and cache. History methods come back as lists rather than iterators.
+    """
 
+    def __init__(self, *args, max_connections: int = 16, **kwargs) -> None:
+        self._client = FtxClient(*args, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
 
-class LedgerEntry:
-  class Item:
-    def __init__(self, account, currency, quantity, inputCommodity, inputQuantity, description):
-      self.currency = normalizeCurrency(currency)
-      self.account = account #"{account}:{currency}".format(account = account, currency = self.currency)
-      self.quantity = quantity
-      self.description = description
-      self.inputCommodity = inputCommodity
-      self.inputQuantity = inputQuantity
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self._client, name)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
 
-    def generateCostBasisText(self):
-      return "" if (self.inputCommodity == None or self.inputQuantity == None) else '{{{quantity:.13f} {commodity}}}'.format(quantity = self.inputQuantity, commodity = normalizeCurrency(self.inputCommodity))
+        def call(*args, **kwargs):
+            result = method(*args, **kwargs)
+            return list(result) if isinstance(result, Iterator) else result
 
-    def generateDescriptionComment(self):
-      return ';; {0}'.format(self.description) if self.description else ''
+        async def coroutine(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: call(*args, **kwargs))
+        return coroutine
 
+    async def close(self) -> None:
+        self._executor.shutdown(wait=False)
 
-    # NB: The precision here is hack; it should really be based on the known precision; i had to force it here to get rid of scientific notation because beancounter doesn't understand it.
-    def __repr__(self):
-      if (self.currency == None or self.quantity == None):
-        return "{account}\t{comment}".format(account=self.account, comment = self.generateDescriptionComment())
-      else:
-        return "{account}\t{quantity:.13f} {currency} {costBasis} {comment}".format(account = self.account, quantity = self.quantity, currency = self.currency, costBasis = self.generateCostBasisText(), comment = self.generateDescriptionComment())
+    async def __aenter__(self) -> 'AsyncFtxClient':
+        return self
 
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
-  def __init__(self, date, description):
-    self.date = date
-    self.description = description
-    self.items = []
-
-  def addItem(self, account, currency = None, quantity = None, inputCommodity = None, inputQuantity = None, description = ''):
-    self.items.append(self.Item(account=account, currency=currency, quantity=quantity,
-                      inputCommodity=inputCommodity, inputQuantity=inputQuantity, description=description))
-
-  def print(self):
-    print('{0} * "{1}"'.format(self.date.strftime("%Y/%m/%d"), self.description))
-    for item in self.items:
-      print("  {}".format(item))
-    print()
 
+import os
+import re
+import json
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import dotenv_values
+from ledger import Ledger, LedgerIndex, normalizeCurrency
+from lots import LotBook
+from prices import PriceStore
+from valuation import Holdings, Valuation
+from pipeline import Source, LedgerSink, runPipeline
+from transforms import fillTransactions, archiveFills, depositTransactions, lendingTransactions, borrowTransactions, \
+  interestBuckets, INTEREST_PERIODS
+from fillarchive import FillArchive
+from metrics import metrics
 
 import sys
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-ledger = Ledger()
-
-# The way that FTX does charges is as follows
-# Say you by 1 BTC for 1000 USD and your Maker fee is 1%
-# You will be 0.01 BTC (BTC because is Maker fee).
-# So you will debit 1000 USD to bay for 1 BTC
-# Then you will debit 0.1 BTC for yoru feel
-# You will then have 0.99 BTC @ 1000 USD and -1000 USD in your accounts
-for fill in ftxClient.get_fills(start_time=0, end_time=2147483647):
-  entry = ledger.addEntry(datetime.fromisoformat(fill['time']), "fillid-{0}: {1} {2} {3} @ {4} {5} ea. {6}".format(
-      fill['id'], fill['side'], fill['size'], fill['baseCurrency'], fill['price'], fill['quoteCurrency'], fill))
-  size = Decimal(str(fill['size']))
-  price = Decimal(str(fill['price']))
-  fee = Decimal(str(fill['fee']))
-  eprint("fill({id}), {date}".format(date = fill['time'], id = fill['id']))
-  entry.addItem(account="Assets:Wallet",
-                currency=fill['baseCurrency'], quantity=size, inputCommodity=fill['quoteCurrency'], inputQuantity=price, description="Purchase")
-  #entry.addItem(account="Assets:Wallet",
-  #              currency=fill['quoteCurrency'], quantity=-price*size, description="y")
-  
-  #  {'id': 63820377, 'market': 'SOL/USD', 'future': None, 'baseCurrency': 'SOL', 'quoteCurrency': 'USD', 
-  # 'type': 'order', 'side': 'buy', 'price': 89.7775, 'size': 15.0, 'orderId': 4216671021, 
-  # 'time': '2022-03-21T13:54:26.393415+00:00', 'tradeId': 27130489, 'feeRate': 0.0008, 'fee': 0.012, 
-  # 'feeCurrency': 'SOL', 'liquidity': 'maker'}
-  doItRight = True
-  if not doItRight and fill['quoteCurrency'] != fill['feeCurrency']:
-    entry.addItem(account="Expenses:Fees", currency=fill['feeCurrency'], quantity=fee, inputCommodity=fill['quoteCurrency'], inputQuantity=price, description='Fee rate of {0} as {makerOrTaker}'.format(fill['feeRate'], makerOrTaker=fill['liquidity']))
+# Each history is a source of its own, so they're all fetched at once. Only what happened after since is
+# fetched, and whatever's in index is left out.
+#
+# With an archive (a FillArchive), fetched fills are added to it, or with fromArchive, fills are read from
+# it rather than fetched. With an interestPeriod (one of INTEREST_PERIODS), lending and borrowing interest
+# is rolled up into one entry per coin for each period.
+def exportAccount(ftxClient, ledger, book = None, index = None, since = None, archive = None, fromArchive = False,
+                  interestPeriod = None):
+  if archive is not None and fromArchive:
+    fills = Source('fills', lambda: archive.fills(start_time=since), fillTransactions(book))
+  elif archive is not None:
+    fills = Source('fills', lambda: ftxClient.get_all_fills(start_time=since or 0), archiveFills(archive), fillTransactions(book))
   else:
-    entry.addItem(account="Expenses:Fees", currency=fill['feeCurrency'], quantity=fee, description='Fee rate of {feeRate} as {makerOrTaker}'.format(feeRate= fill['feeRate'], makerOrTaker = fill['liquidity']))
-  entry.addItem(account="Assets:Wallet", currency=fill['feeCurrency'])
-
-
-for deposit in ftxClient.get_deposit_history():
-  if deposit['size'] != None:
-    currency = deposit['coin']
-    quantity = deposit['size']
-    entry = ledger.addEntry(
-      date=datetime.fromisoformat(deposit['time']),
-      description = 'Deposit {0} {1}'.format(quantity, currency))
-    entry.addItem(
-      account = 'Assets:Wallet',
-      currency = currency,
-      quantity = quantity,
-      description = '')
-    entry.addItem(
-      account = 'Income:Investments',
-      currency=currency,
-      quantity = -quantity,
-      description='')
-
-#{'coin': 'SOL', 'time': '2022-03-31T05:00:00+00:00', 'size': 1100.306557, 'rate': 1.142e-05, 'proceeds': 0.01256550088094, 'feeUsd': 1.5198590173526874}
-for loan in ftxClient.get_lending_history():
-  quantity = loan['proceeds']
-  currency = loan['coin']
-
-  entry = ledger.addEntry(
-      date=datetime.fromisoformat(loan['time']),
-      description='Lending Interest {0} {1} ; {2}'.format(quantity, currency, loan))
-  entry.addItem(account='Assets:Wallet:Interest', currency=currency,
-                quantity=quantity, description='')
-  entry.addItem(account='Income:Interest', currency=currency,
-                quantity=-quantity, description='')
-
-# add borrows
-# {'coin': 'USD', 'time': '2022-03-31T15:00:00+00:00', 'size': 575.8747286, 'rate': 2e-06, 'cost': 0.0011517494572, 'feeUsd': 0.0011517494572}
-for loan in ftxClient.get_borrow_history():
-  quantity = loan['cost']
-  currency = loan['coin']
-
-  entry = ledger.addEntry(
-      date=datetime.fromisoformat(loan['time']),
-      description='Borrowing Interest {0} {1}'.format(quantity, currency))
-  entry.addItem(account = 'Assets:Wallet:Interest', currency = currency, quantity = -quantity, description='')
-  entry.addItem(account='Income:Interest', currency = currency,
-                quantity = quantity, description='')
-
-print('option "operating_currency" "USD"')
-
-(accounts, currencies) = ledger.getAccountsAndCurrencies()
-for account in accounts:
-  print("2003-01-05 open {0}".format(account))
-
-for currency in currencies:
-  print(
-  """
-2000-01-01 commodity {currency}
-  price: "USD:coinbase/{currency}-USD"
-  """.format(currency = currency))
-
-for entry in ledger.getEntries():
-  entry.print()
-
-print('plugin "beancount.plugins.unrealized" "Unrealized"')
+    fills = Source('fills', lambda: ftxClient.get_all_fills(start_time=since or 0), fillTransactions(book))
+  lending = [interestBuckets(interestPeriod, 'proceeds')] if interestPeriod else []
+  borrowing = [interestBuckets(interestPeriod, 'cost')] if interestPeriod else []
+  runPipeline([
+    fills,
+    Source('deposits', lambda: ftxClient.get_deposit_history(start_time=since), depositTransactions),
+    Source('lending', lambda: ftxClient.get_lending_history(start_time=since), *lending, lendingTransactions),
+    Source('borrowing', lambda: ftxClient.get_borrow_history(start_time=since), *borrowing, borrowTransactions),
+  ], LedgerSink(ledger, index))
+
+
+# Prices in USD, from the exchange's daily candles, for every currency on every day it was traded.
+def addPrices(ftxClient, ledger, store):
+  for (currency, dates) in sorted(ledger.priceDates.items()):
+    if normalizeCurrency(currency) == 'USD':
+      continue
+    market = '{0}/USD'.format(currency)
+    start = datetime.combine(min(dates), datetime.min.time(), timezone.utc).timestamp()
+    end = datetime.combine(max(dates) + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp()
+    try:
+      store.update(ftxClient.get_all_historical_prices, market, start, end)
+    except Exception as error:
+      eprint("no prices for {0}: {1}".format(market, error))
+      continue
+    for date in sorted(dates):
+      # The close of the last candle that day.
+      price = store.price(market, datetime.combine(date + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp() - 1)
+      if price is not None:
+        ledger.addPrice(date, currency, price, 'USD')
+
+# The USD value of everything held, at midnight UTC of every day from the first deposit or fill on.
+def writeNav(path, ftxClient, ledger, store):
+  holdings = Holdings.from_ledger(ledger)
+  if holdings.first_time() is None:
+    return
+  start = datetime.fromtimestamp(holdings.first_time(), timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+  end = ledger.lastDate.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+  for currency in holdings.currencies():
+    if normalizeCurrency(currency) != 'USD':
+      try:
+        store.update(ftxClient.get_all_historical_prices, '{0}/USD'.format(currency), start.timestamp(), end.timestamp())
+      except Exception as error:
+        eprint("no prices for {0}: {1}".format(currency, error))
+  with open(path, 'w') as out:
+    out.write('date,usd\n')
+    for (when, value) in Valuation(holdings, store).nav(start.timestamp(), end.timestamp()):
+      out.write('{0},{1:.2f}\n'.format(datetime.fromtimestamp(when, timezone.utc).strftime('%Y-%m-%d'), value))
+
+# Beancount account names are made of capitalized components, so derive one from the subaccount's nickname.
+def accountPrefix(subaccount):
+  prefix = re.sub('[^A-Za-z0-9-]+', '-', subaccount).strip('-')
+  return prefix[:1].upper() + prefix[1:] if prefix[:1].isalpha() else 'Sub' + prefix
+
+# The exchange's limit of 30 requests a second is per key, and the workers exporting accounts with --accounts
+# can't share a rate limiter, so each gets an even share of it. A share below one request a second would
+# leave a worker's bucket unable to hold the one token a request takes, so there are never more workers than
+# that allows. Returns how many workers to run and the requests a second each of them gets.
+def splitRateLimit(workers, accounts, requestsPerSecond = 30):
+  workers = max(1, min(workers, accounts, int(requestsPerSecond)))
+  return (workers, requestsPerSecond / workers)
+
+# Runs in a worker process: export one subaccount into a sorted run at runPath and send back the ledger,
+# now holding only its indexes, to be merged, along with what the worker's metrics recorded and the keys it
+# added to (its copy of) index.
+def exportSubaccount(account, runPath, keepRaw, requestsPerSecond, cache, booking, selections, trackHoldings, index,
+                     since, interestPeriod):
+  # Workers are reused, and forked ones start out with a copy of the parent's metrics.
+  metrics.clear()
+  ftxClient = FtxClient(api_key=account['api_key'], api_secret=account['api_secret'],
+                        subaccount_name=account.get('subaccount'),
+                        rate_limiter=RateLimiter(rate=requestsPerSecond, capacity=max(1, requestsPerSecond)), cache=cache)
+  prefix = account.get('prefix') or (accountPrefix(account['subaccount']) if account.get('subaccount') else None)
+  ledger = Ledger(keepRaw=keepRaw, accountPrefix=prefix, trackHoldings=trackHoldings)
+  exportAccount(ftxClient, ledger, LotBook(booking, selections) if booking else None, index, since, interestPeriod=interestPeriod)
+  ledger.saveRun(runPath)
+  return (ledger, metrics.snapshot(), index.added if index is not None else [])
+
+def main():
+  parser = argparse.ArgumentParser(description='Convert your FTX US account into a beancount ledger.')
+  parser.add_argument('--output', help='write the ledger here instead of to stdout')
+  parser.add_argument('--no-raw', dest='raw', action='store_false', help="leave the exchange's raw records out of entry descriptions")
+  parser.add_argument('--balance-assertions', action='store_true', help='finish the ledger with a balance assertion for every account')
+  parser.add_argument('--accounts', help='JSON list of {"api_key", "api_secret", "subaccount", "prefix"} to export together, one process each')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='how many accounts to export at once with --accounts')
+  parser.add_argument('--render-workers', type=int, help='render the ledger\'s entries with this many processes, keeping up to a million of them in memory for it')
+  parser.add_argument('--cache-dir', help='keep raw API responses here and reuse them on later runs')
+  parser.add_argument('--cache-ttl', type=float, default=60 * 60, help='seconds before a cached response is fetched again')
+  parser.add_argument('--offline', action='store_true', help='replay responses from --cache-dir without touching the exchange')
+  parser.add_argument('--append', action='store_true', help='only add what isn\'t in --output yet, going by the keys kept in <output>.keys')
+  parser.add_argument('--fill-archive', help='keep every fill fetched in this binary archive')
+  parser.add_argument('--fills-from-archive', action='store_true', help='read fills from --fill-archive instead of fetching them')
+  parser.add_argument('--shard-dir', help='write entries to one file per period here, and includes for them to --output')
+  parser.add_argument('--shard-by', choices=['year', 'month'], default='year', help='how much of the ledger goes in each shard')
+  parser.add_argument('--price-dir', help='keep candles here and write a price for every currency on every day it was traded')
+  parser.add_argument('--price-resolution', type=int, default=24 * 60 * 60, help='seconds per candle kept in --price-dir')
+  parser.add_argument('--nav', help='write the USD value of the accounts at the start of every day here as CSV (needs --price-dir)')
+  parser.add_argument('--metrics-file', help='also write the run\'s metrics here in the Prometheus text format')
+  parser.add_argument('--profile-dir', help='profile every stage of the run with cProfile into <stage>.prof files here')
+  parser.add_argument('--trace-memory', action='store_true', help='record the peak memory of every stage with tracemalloc')
+  parser.add_argument('--booking', choices=sorted(LotBook.METHODS), help='match sells against lots this way and realize their gains')
+  parser.add_argument('--lot-selections', help='JSON object of sell fill id to the id of the buy fill whose lot it sells, for --booking SPECIFIC')
+  parser.add_argument('--interest-period', choices=INTEREST_PERIODS, help='roll hourly lending and borrowing interest up into one entry per coin per period')
+  args = parser.parse_args()
+  if args.offline and not args.cache_dir:
+    parser.error('--offline needs --cache-dir')
+  if args.nav and not args.price_dir:
+    parser.error('--nav needs --price-dir')
+  if args.fills_from_archive and not args.fill_archive:
+    parser.error('--fills-from-archive needs --fill-archive')
+  if args.fill_archive and args.accounts:
+    parser.error('--fill-archive only works with a single account')
+  if args.append and (not args.output or args.shard_dir or args.balance_assertions or args.nav):
+    parser.error('--append needs --output, and only has the new entries to go on, so no --shard-dir, --balance-assertions or --nav')
+  if (args.booking == 'SPECIFIC') != bool(args.lot_selections):
+    parser.error('--booking SPECIFIC needs --lot-selections, and --lot-selections only goes with it')
+  selections = None
+  if args.lot_selections:
+    with open(args.lot_selections) as selectionsFile:
+      selections = {str(sell): str(buy) for (sell, buy) in json.load(selectionsFile).items()}
+  if args.append and args.interest_period:
+    # The period still going on would be written once and never topped up.
+    parser.error('--interest-period can\'t be used with --append')
+  cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl, offline=args.offline) if args.cache_dir else None
+  metrics.profile_dir = args.profile_dir
+  metrics.trace_memory = args.trace_memory
+
+  index = LedgerIndex(args.output + '.keys') if args.append else None
+  since = None
+  if index is not None and index.newest is not None and not args.booking:
+    # Lots have to be booked from the beginning, but otherwise only recent history can hold anything new.
+    # Records can turn up a little late, so look back a day.
+    since = index.newest - 24 * 60 * 60
+
+  ledger = Ledger(keepRaw=args.raw, trackHoldings=bool(args.nav), renderWorkers=args.render_workers)
+  with metrics.stage('export'):
+    if args.accounts:
+      with open(args.accounts) as accountsFile:
+        accounts = json.load(accountsFile)
+      (workers, requestsPerSecond) = splitRateLimit(args.workers, len(accounts))
+      runDirectory = tempfile.TemporaryDirectory()
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+        runPaths = [os.path.join(runDirectory.name, '{0}.run'.format(i)) for i in range(len(accounts))]
+        for ((accountLedger, accountMetrics, added), runPath) in zip(executor.map(exportSubaccount, accounts, runPaths, [args.raw] * len(accounts),
+                                                                                  [requestsPerSecond] * len(accounts), [cache] * len(accounts),
+                                                                                  [args.booking] * len(accounts), [selections] * len(accounts),
+                                                                                  [bool(args.nav)] * len(accounts),
+                                                                                  [index] * len(accounts), [since] * len(accounts),
+                                                                                  [args.interest_period] * len(accounts)), runPaths):
+          ledger.addLedger(accountLedger, runPath)
+          metrics.merge(accountMetrics)
+          for key in added:
+            index.add(key)
+      ftxClient = FtxClient(api_key=accounts[0]['api_key'], api_secret=accounts[0]['api_secret'], cache=cache)
+    else:
+      config = dotenv_values(".env")
+      ftxClient  = FtxClient(api_key = config['API_KEY'],
+                api_secret = config['API_SECRET'], cache = cache)
+      archive = FillArchive(args.fill_archive) if args.fill_archive else None
+      exportAccount(ftxClient, ledger, LotBook(args.booking, selections) if args.booking else None, index, since,
+                    archive, args.fills_from_archive, args.interest_period)
+
+  if args.price_dir:
+    store = PriceStore(args.price_dir, resolution=args.price_resolution)
+    with metrics.stage('prices'):
+      addPrices(ftxClient, ledger, store)
+    if args.nav:
+      with metrics.stage('nav'):
+        writeNav(args.nav, ftxClient, ledger, store)
+
+  with metrics.stage('write'):
+    if args.append:
+      ledger.append(args.output, index)
+    elif args.shard_dir:
+      ledger.writeShards(args.output or os.path.join(args.shard_dir, 'ledger.beancount'), args.shard_dir,
+                         period=args.shard_by, balanceAssertions=args.balance_assertions)
+    else:
+      with (open(args.output, 'w', buffering=1 << 20) if args.output else sys.stdout) as out:
+        ledger.write(out, balanceAssertions=args.balance_assertions)
+
+  eprint(metrics.summary(), end='')
+  if args.metrics_file:
+    metrics.write_prometheus(args.metrics_file)
 # Next step get the costs in this
 
-
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,118 @@
+from bisect import bisect_right
+from decimal import Decimal
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+from ledger import normalizeCurrency
+from prices import PriceStore
+
+
+class Holdings:
+    """
+    How much of each currency is held over time: per currency, the times its holdings changed, in order, and
+    the running total after each change. Built from the changes a Ledger collects with trackHoldings on.
+    """
+
+    def __init__(self, changes: Dict[str, Dict[float, Decimal]]) -> None:
+        self._times: Dict[str, List[float]] = {}
+        self._totals: Dict[str, List[Decimal]] = {}
+        for currency, quantities in changes.items():
+            times = sorted(quantities)
+            self._times[currency] = times
+            self._totals[currency] = list(accumulate(quantities[time] for time in times))
+
+    @classmethod
+    def from_ledger(cls, ledger) -> 'Holdings':
+        return cls(ledger.holdings)
+
+    def currencies(self) -> List[str]:
+        return sorted(self._times)
+
+    def first_time(self) -> Optional[float]:
+        return min((times[0] for times in self._times.values() if times), default=None)
+
+    def quantity(self, currency: str, when: float) -> Decimal:
+        times = self._times.get(currency)
+        i = bisect_right(times, when) - 1 if times else -1
+        return self._totals[currency][i] if i >= 0 else Decimal(0)
+
+    def series(self, currency: str) -> Tuple[List[float], List[Decimal]]:
+        return self._times.get(currency, []), self._totals.get(currency, [])
+
+
+def _as_of(times, values, samples: List[float], default):
+    """
+    For each of the sorted samples, the value at the last time at or before it. Both sides are sorted, so
+    this is a single merge over the two rather than a search per sample.
+    """
+    i = bisect_right(times, samples[0]) - 1 if samples else -1
+    value = values[i] if i >= 0 else default
+    i += 1
+    count = len(times)
+    result = []
+    for sample in samples:
+        while i < count and times[i] <= sample:
+            value = values[i]
+            i += 1
+        result.append(value)
+    return result
+
+
+class Valuation:
+    """
+    Values holdings in USD at candle closes from a PriceStore. A currency's price at time T is the close of
+    its last candle that had closed by T, that is, started at least a candle's resolution before it: a
+    candle that's still open at T has a close that isn't known yet. USD and the stablecoins count as 1. A
+    currency with no closed candle at T contributes nothing.
+
+    `markets` maps currencies to the markets they're priced on, by default '<currency>/USD'.
+    """
+
+    def __init__(self, holdings: Holdings, store: PriceStore, markets: Dict[str, str] = None) -> None:
+        self._holdings = holdings
+        self._store = store
+        self._markets = markets or {}
+
+    def _market(self, currency: str) -> Optional[str]:
+        if normalizeCurrency(currency) == 'USD':
+            return None
+        return self._markets.get(currency, f'{currency}/USD')
+
+    def value(self, when: float) -> Decimal:
+        """What everything held at `when` was worth in USD."""
+        total = Decimal(0)
+        for currency in self._holdings.currencies():
+            quantity = self._holdings.quantity(currency, when)
+            if not quantity:
+                continue
+            market = self._market(currency)
+            price = Decimal(1) if market is None else self._store.price(market, when - self._store.resolution)
+            if price is not None:
+                total += quantity * price
+        return total
+
+    def nav(self, start: float, end: float, step: float = 24 * 60 * 60) -> List[Tuple[float, float]]:
+        """
+        (time, USD value) every `step` seconds from start to end. Each currency is joined against the sample
+        times once, in a single pass over its holdings and another over its candles, however long the
+        history is; values are floats since they're meant for curves rather than books.
+        """
+        samples = []
+        when = start
+        while when <= end:
+            samples.append(when)
+            when += step
+        totals = [0.0] * len(samples)
+        for currency in self._holdings.currencies():
+            times, quantities = self._holdings.series(currency)
+            held = _as_of(times, [float(quantity) for quantity in quantities], samples, 0.0)
+            market = self._market(currency)
+            if market is None:
+                prices = [1.0] * len(samples)
+            else:
+                candle_times, closes = self._store.columns(market)
+                closed = [sample - self._store.resolution for sample in samples]
+                prices = _as_of(candle_times, closes, closed, 0.0)
+            for i, (quantity, price) in enumerate(zip(held, prices)):
+                totals[i] += quantity * price
+        return list(zip(samples, totals))
@@ -0,0 +1,28 @@
+import os
+import stat
+
+import pytest
+
+from atomicfile import FILE_MODE, replace_atomically
+
+
+def mode(path):
+  return stat.S_IMODE(os.stat(path).st_mode)
+
+def testGivesTheModeOpenWould(tmp_path):
+  with open(tmp_path / 'opened', 'w'):
+    pass
+  with replace_atomically(str(tmp_path / 'replaced'), 'w') as out:
+    out.write('new')
+  assert (tmp_path / 'replaced').read_text() == 'new'
+  assert mode(tmp_path / 'replaced') == mode(tmp_path / 'opened') == FILE_MODE
+
+def testLeavesTheFileAloneIfWritingFails(tmp_path):
+  path = tmp_path / 'ledger'
+  path.write_bytes(b'old')
+  with pytest.raises(RuntimeError):
+    with replace_atomically(str(path)) as out:
+      out.write(b'half')
+      raise RuntimeError()
+  assert path.read_bytes() == b'old'
+  assert os.listdir(tmp_path) == ['ledger']
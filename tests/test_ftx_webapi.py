@@ -0,0 +1,114 @@
+import json
+import time
+import threading
+import importlib
+import http.server
+
+import pytest
+
+from metrics import Metrics
+
+webapi = importlib.import_module('use-ftx-webapi')
+
+
+@pytest.mark.parametrize('workers, accounts, expected', [
+  (8, 3, (3, 10.0)),
+  (4, 100, (4, 7.5)),
+  (0, 5, (1, 30.0)),
+  # Dozens of subaccounts on a big machine: any more workers and a share would be under a request a second.
+  (64, 100, (30, 1.0)),
+])
+def testSplitRateLimit(workers, accounts, expected):
+  assert webapi.splitRateLimit(workers, accounts) == expected
+
+
+def testEveryShareCanMakeARequest():
+  for workers in (1, 7, 30, 31, 128):
+    _, share = webapi.splitRateLimit(workers, 1000)
+    assert share >= 1
+    limiter = webapi.RateLimiter(rate=share, capacity=max(1, share))
+    started = time.monotonic()
+    limiter.acquire(1)
+    assert time.monotonic() - started < 0.1
+
+
+# A stand-in for the exchange on a local port. Each request is answered with the next of `responses`,
+# (status, headers, body, seconds to stall first), and the paths asked for are kept in `requests`.
+class StubExchange(http.server.BaseHTTPRequestHandler):
+  responses = []
+  requests = []
+
+  def do_GET(self):
+    StubExchange.requests.append(self.path)
+    (status, headers, body, stall) = StubExchange.responses.pop(0)
+    time.sleep(stall)
+    self.send_response(status)
+    # A Content-Length of its own makes for a body that breaks off.
+    for (name, value) in {'Content-Length': str(len(body)), **headers}.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+OK = (200, {}, json.dumps({'success': True, 'result': [{'id': 1}]}).encode(), 0)
+
+@pytest.fixture
+def exchange():
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubExchange)
+  StubExchange.responses = []
+  StubExchange.requests = []
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield 'http://127.0.0.1:{0}/api/'.format(server.server_address[1])
+  server.shutdown()
+  server.server_close()
+
+def client(endpoint, **options):
+  return webapi.FtxClient(api_key='key', api_secret='secret', endpoint=endpoint, backoff=0.01, metrics=Metrics(), **options)
+
+def testRetriesAfterWhatRetryAfterSays(exchange):
+  StubExchange.responses = [(429, {'Retry-After': '0.3'}, b'{}', 0), OK]
+  started = time.monotonic()
+  assert client(exchange).get_markets() == [{'id': 1}]
+  assert time.monotonic() - started >= 0.3
+  assert StubExchange.requests == ['/api/markets'] * 2
+
+def testBacksOffOnServerErrorsUntilOutOfRetries(exchange):
+  error = (503, {}, json.dumps({'success': False, 'error': 'unavailable'}).encode(), 0)
+  StubExchange.responses = [error] * 3
+  ftx = client(exchange, max_retries=2)
+  with pytest.raises(Exception, match='unavailable'):
+    ftx.get_markets()
+  assert len(StubExchange.requests) == 3
+  assert ftx._metrics.snapshot()['counters'][('ftx_retries_total', (('endpoint', 'markets'),))] == 2
+
+def testRetriesAStalledResponse(exchange):
+  StubExchange.responses = [OK[:3] + (1,), OK]
+  assert client(exchange, timeout=(1, 0.2)).get_markets() == [{'id': 1}]
+  assert len(StubExchange.requests) == 2
+
+def testEndpointWeightsComeOutOfTheBucket(exchange):
+  StubExchange.responses = [OK, OK]
+  acquired = []
+  class RecordingLimiter(webapi.RateLimiter):
+    def acquire(self, tokens=1):
+      acquired.append(tokens)
+      webapi.RateLimiter.acquire(self, tokens)
+  ftx = client(exchange, rate_limiter=RecordingLimiter(), endpoint_weights={'markets': 5})
+  ftx.get_markets()
+  ftx.get_coins()
+  assert acquired == [5, 1]
+
+def testAWeightTheBucketCanNeverHoldIsAnError(exchange):
+  ftx = client(exchange, rate_limiter=webapi.RateLimiter(rate=2, capacity=2), endpoint_weights={'markets': 3})
+  with pytest.raises(ValueError):
+    ftx.get_markets()
+  assert StubExchange.requests == []
+
+def testRefetchesAPageWhoseBodyBreaksOff(exchange):
+  page = json.dumps({'success': True, 'result': [{'coin': 'SOL', 'time': '1970-01-01T00:16:45+00:00', 'proceeds': 1}]}).encode()
+  StubExchange.responses = [(200, {'Content-Length': str(len(page) + 100)}, page[:-20], 0), (200, {}, page, 0)]
+  assert [payment['proceeds'] for payment in client(exchange).get_lending_history(start_time=1000, end_time=1010)] == [1]
+  assert len(StubExchange.requests) == 2
@@ -0,0 +1,74 @@
+import io
+import random
+import hashlib
+import multiprocessing
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ledger import Ledger
+
+START = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+# Fills and interest in shuffled order, several to a timestamp, so rendering has sorting and ties to get
+# right as well as formatting.
+def buildLedger(count, **options):
+  rng = random.Random(0)
+  ledger = Ledger(**options)
+  for i in rng.sample(range(count), count):
+    date = START + timedelta(minutes=i // 3)
+    if i % 4:
+      size = Decimal(rng.randrange(1, 100000)).scaleb(-4)
+      price = Decimal(rng.randrange(1, 5000000)).scaleb(-2)
+      entry = ledger.addEntry(date, 'fillid-{0}: buy {1} SOL @ {2} USD ea.'.format(i, size, price), raw={'id': i})
+      entry.addItem(account='Assets:Wallet', currency='SOL', quantity=size, inputCommodity='USD', inputQuantity=price,
+                    description='Purchase')
+      entry.addItem(account='Expenses:Fees', currency='USD', quantity=Decimal('0.01'), description='Fee')
+      entry.addItem(account='Assets:Wallet', currency='USD')
+    else:
+      proceeds = Decimal(rng.randrange(1, 10 ** 12)).scaleb(-14)
+      entry = ledger.addEntry(date, 'Lending Interest {0} SOL'.format(proceeds), meta={'records': 24})
+      entry.addItem(account='Assets:Wallet:Interest', currency='SOL', quantity=proceeds)
+      entry.addItem(account='Income:Interest', currency='SOL', quantity=-proceeds)
+  return ledger
+
+
+def written(ledger):
+  out = io.StringIO()
+  ledger.write(out, balanceAssertions=True)
+  return hashlib.sha256(out.getvalue().encode('utf-8')).hexdigest()
+
+
+needsFork = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='renders serially without fork')
+
+
+@needsFork
+def testParallelRenderingWritesTheSameBytes():
+  assert written(buildLedger(5000, renderWorkers=3, renderChunkSize=97)) == written(buildLedger(5000))
+
+
+@needsFork
+def testParallelRenderingWithSpilledRunsWritesTheSameBytes():
+  assert written(buildLedger(5000, runSize=700, renderWorkers=3, renderChunkSize=97)) == written(buildLedger(5000, runSize=700))
+
+
+@needsFork
+def testParallelRenderingUsesWorkers(monkeypatch):
+  pools = []
+  forkContext = type(multiprocessing.get_context('fork'))
+  pool = forkContext.Pool
+
+  def recordingPool(self, processes = None, *args, **kwargs):
+    pools.append(processes)
+    return pool(self, processes, *args, **kwargs)
+  monkeypatch.setattr(forkContext, 'Pool', recordingPool)
+  written(buildLedger(1000, renderWorkers=2, renderChunkSize=100))
+  assert pools == [2]
+
+
+def testRenderWorkersKeepMoreEntriesInMemory():
+  assert Ledger().runSize == Ledger.RUN_SIZE
+  assert Ledger(renderWorkers=4).runSize == Ledger.RENDER_RUN_SIZE
+  assert Ledger(runSize=700, renderWorkers=4).runSize == 700
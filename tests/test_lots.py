@@ -0,0 +1,77 @@
+from decimal import Decimal
+from datetime import date
+
+import pytest
+
+from lots import LotBook
+from transforms import fillTransactions
+
+
+def buy(book, quantity, cost, costCurrency, day, lotId):
+  book.acquire('ETH', Decimal(quantity), Decimal(cost), costCurrency, date(2022, 3, day), lotId=lotId)
+
+# Three lots: the middle one the most expensive.
+def threeLots(method, selections = None):
+  book = LotBook(method, selections)
+  buy(book, '1', '2000', 'USD', 1, '1')
+  buy(book, '1', '3000', 'USD', 2, '2')
+  buy(book, '1', '2500', 'USD', 3, '3')
+  return book
+
+def matched(disposals):
+  return [(disposal.lot.lotId if disposal.lot else None, disposal.quantity) for disposal in disposals]
+
+
+@pytest.mark.parametrize('method, expected', [
+  ('FIFO', [('1', 1), ('2', Decimal('0.5'))]),
+  ('LIFO', [('3', 1), ('2', Decimal('0.5'))]),
+  ('HIFO', [('2', 1), ('3', Decimal('0.5'))]),
+])
+def testMatchesLotsInBookingOrder(method, expected):
+  book = threeLots(method)
+  assert matched(book.dispose('ETH', Decimal('1.5'), Decimal('2800'), 'USD')) == expected
+  assert sum(lot.quantity for lot in book.getLots('ETH')) == Decimal('1.5')
+
+def testSpecificTakesTheSelectedLotThenTheOldest():
+  book = threeLots('SPECIFIC', {'sell': '3'})
+  assert matched(book.dispose('ETH', Decimal('1.5'), Decimal('2800'), 'USD', lotId=book.selections['sell'])) == \
+    [('3', 1), ('1', Decimal('0.5'))]
+  # The selected lot is used up, so it's skipped from then on.
+  assert matched(book.dispose('ETH', Decimal('1.5'), Decimal('2800'), 'USD', lotId='3')) == \
+    [('1', Decimal('0.5')), ('2', 1)]
+
+def testWhatIsLeftOverHasNoLot():
+  book = threeLots('FIFO')
+  disposals = book.dispose('ETH', Decimal('4'), Decimal('2800'), 'USD')
+  assert matched(disposals)[-1] == (None, 1)
+  assert disposals[-1].getGain() is None
+
+def testGainsAreInTheProceedsCurrency():
+  book = threeLots('FIFO')
+  assert [disposal.getGain() for disposal in book.dispose('ETH', Decimal('2'), Decimal('2800'), 'USD')] == [800, -200]
+
+def testHifoDoesNotCompareCostsInDifferentCurrencies():
+  book = LotBook('HIFO')
+  buy(book, '1', '0.07', 'BTC', 1, 'btc-1')
+  buy(book, '1', '2000', 'USD', 2, 'usd-1')
+  buy(book, '1', '0.09', 'BTC', 3, 'btc-2')
+  buy(book, '1', '2500', 'USD', 4, 'usd-2')
+  # Sold for USD: the USD lots first, most expensive first, then the other lots, earliest bought first.
+  assert matched(book.dispose('ETH', Decimal('3.5'), Decimal('2800'), 'USD')) == \
+    [('usd-2', 1), ('usd-1', 1), ('btc-2', 1), ('btc-1', Decimal('0.5'))]
+
+def testCrossQuoteSaleRealizesTheProceeds():
+  fills = [
+    {'id': 1, 'market': 'ETH/BTC', 'baseCurrency': 'ETH', 'quoteCurrency': 'BTC', 'side': 'buy', 'price': '0.07', 'size': '1',
+     'time': '2022-03-01T00:00:00+00:00', 'feeRate': 0, 'fee': '0', 'feeCurrency': 'BTC', 'liquidity': 'maker'},
+    {'id': 2, 'market': 'ETH/USD', 'baseCurrency': 'ETH', 'quoteCurrency': 'USD', 'side': 'sell', 'price': '3000', 'size': '1',
+     'time': '2022-03-02T00:00:00+00:00', 'feeRate': 0, 'fee': '0.5', 'feeCurrency': 'USD', 'liquidity': 'maker'},
+  ]
+  sale = list(fillTransactions(LotBook('FIFO'))(fills))[1]
+  postings = [(posting['account'], posting['currency'], posting.get('quantity')) for posting in sale.postings]
+  assert ('Assets:Wallet', 'ETH', Decimal('-1')) in postings
+  assert ('Assets:Wallet', 'USD', Decimal('3000')) in postings
+  assert ('Income:Gains', 'USD', Decimal('-3000')) in postings
+  assert ('Income:Gains', 'BTC', Decimal('0.07')) in postings
+  # The ETH is held at a BTC cost, which a USD price can't go with.
+  assert [posting.get('price') for posting in sale.postings if posting['currency'] == 'ETH'] == [None]
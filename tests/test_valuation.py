@@ -0,0 +1,28 @@
+from decimal import Decimal
+
+from prices import PriceStore
+from valuation import Holdings, Valuation
+
+DAY = 24 * 60 * 60
+START = 1640995200  # 2022-01-01T00:00:00Z
+
+
+# Daily candles closing at 100, 200 and 300, and a coin held from just before the first of them.
+def valuation(directory):
+  store = PriceStore(str(directory))
+  candles = [{'time': (START + i * DAY) * 1000, 'close': close} for (i, close) in enumerate([100.0, 200.0, 300.0])]
+  store.update(lambda market, resolution, start, end: candles, 'SOL/USD', START, START + 3 * DAY, now=START + 10 * DAY)
+  return Valuation(Holdings({'SOL': {START - 1: Decimal(1)}, 'USD': {START - 1: Decimal(5)}}), store)
+
+def testValueOnlyUsesClosedCandles(tmp_path):
+  nav = valuation(tmp_path)
+  # The first candle is still open until the end of its day.
+  assert nav.value(START) == 5
+  assert nav.value(START + DAY - 1) == 5
+  assert nav.value(START + DAY) == 105
+  assert nav.value(START + DAY + 1) == 105
+  assert nav.value(START + 3 * DAY) == 305
+
+def testNavOnlyUsesClosedCandles(tmp_path):
+  nav = valuation(tmp_path)
+  assert nav.nav(START, START + 3 * DAY) == [(START, 5.0), (START + DAY, 105.0), (START + 2 * DAY, 205.0), (START + 3 * DAY, 305.0)]